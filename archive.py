@@ -0,0 +1,297 @@
+"""
+Define a memory-compact archive for processed and failed payments.  Payments themselves are not a good thing to keep
+around forever: each one carries its own attribute dictionary and a reference to the database.  Instead, the archive
+stores each payment as an archive record, which is a named tuple holding only the values of the fields named by
+payment.payment_fields.  Records can be read just like the payment they were made from, e.g. record.product_id, and
+can be turned back into a payment with to_payment if the payment needs to be processed again.
+
+An archive may also be given a window, in which case only the most recently archived payments are kept in memory and
+older ones are spilled to a file on disk, so that a long-running processor does not grow without limit.  The spill file
+is an SQLite database holding the same JSON encoded records as sqlite_database.py, keyed by payment_id, so nothing about
+spilled records, not even their keys, is held in memory.
+
+Archives index their payments by product_id, so that every payment for a product can be found without scanning the
+whole archive, e.g. to recompute commissions when a rate changes (see recompute.py).  Records in memory are indexed in
+memory, and spilled records by an index on a product_id column of the spill file, as in sqlite_database.py.
+"""
+
+import json
+import operator
+import os
+import sqlite3
+from collections import namedtuple
+from collections.abc import MutableMapping
+
+from payment import declared_class, find_payment_class, payment_fields
+
+_record_classes = {}
+
+class ArchiveRecordBase:
+    """
+    Methods shared by the record classes of every payment class.  Record classes are created by record_class.
+    """
+    __slots__ = ()
+    payment_class = None
+
+    @property
+    def payment_type(self):
+        """
+        The name of the class of payment this record was made from.
+        """
+        return self.payment_class.__name__
+
+    def to_payment(self, database):
+        """
+        Re-create the payment this record was made from, without running its constructor or assigning it a new id.
+
+        :param database: A reference to the system database, for the payment to use.
+        :return: A new payment object, equal in every field to the one archived.
+        """
+        cls = self.payment_class
+        payment = cls.__new__(cls)
+        payment.database = database
+        for field, value in zip(self._fields, self):
+            setattr(payment, field, value)
+        return payment
+
+    def __reduce__(self):
+        # Record classes are created at runtime and cannot be found by name, so pickle records by their values.
+        return from_values, (self.payment_type, tuple(self))
+
+def record_class(cls):
+    """
+    Get the archive record class for a payment class, creating it the first time it is needed.
+
+    :param cls: The payment class, or the type of a payment.
+    :return: A named tuple class with one field for each of payment_fields(cls).
+    """
+    try:
+        return _record_classes[cls]
+    except KeyError:
+        pass
+
+    declared = declared_class(cls)
+    if declared is not cls:
+        record_cls = _record_classes[cls] = record_class(declared)
+        return record_cls
+
+    fields = payment_fields(cls)
+    base = namedtuple(f"Archived{cls.__name__}", fields)
+    record_cls = _record_classes[cls] = type(base.__name__, (ArchiveRecordBase, base), {
+        "__slots__": (),
+        "payment_class": cls,
+        "_get_values": operator.attrgetter(*fields),
+    })
+    return record_cls
+
+def to_record(payment):
+    """
+    Make the archive record for a payment.  Records are returned unchanged.
+    """
+    if isinstance(payment, ArchiveRecordBase):
+        return payment
+    record_cls = record_class(type(payment))
+    return tuple.__new__(record_cls, record_cls._get_values(payment))
+
+def from_values(payment_type, values):
+    """
+    Make an archive record from the name of a payment class and the values of its fields, as stored on disk.
+    """
+    record_cls = record_class(find_payment_class(payment_type))
+    return tuple.__new__(record_cls, values)
+
+class OrderArchive(MutableMapping):
+    """
+    An archive of payments keyed by payment_id, stored as archive records.  Payments are archived by assigning them,
+    e.g. archive[payment.payment_id] = payment, and archive records are what is read back.  If window is given,
+    at most that many records are kept in memory, and the oldest records are spilled to a file on disk.  Spilled
+    records can still be read, popped and iterated over, just more slowly.  A windowed archive pickles as an empty
+    archive, see __reduce_ex__.
+    """
+    def __init__(self, window=None, spill_path=None):
+        """
+        :param window: The maximum number of records to keep in memory, or None for no limit.
+        :param spill_path: The path of the file to spill records to.  Required if window is given.  The file is
+        overwritten.
+        """
+        if window is not None and spill_path is None:
+            raise ValueError("Invalid argument: spill_path is required when window is given.")
+        self.window = window
+        self._memory = {}
+        self._spilled = None
+        self._spilled_count = 0
+        if window is not None:
+            if os.path.exists(spill_path):
+                os.remove(spill_path)
+            self._spilled = sqlite3.connect(spill_path, check_same_thread=False)
+            # The file is scratch space, overwritten whenever an archive is created, so it needs no journal or syncing.
+            self._spilled.execute("PRAGMA journal_mode = OFF")
+            self._spilled.execute("PRAGMA synchronous = OFF")
+            self._spilled.execute(
+                "CREATE TABLE spilled (payment_id INTEGER PRIMARY KEY, payment_type TEXT NOT NULL, "
+                "product_id, record TEXT NOT NULL)"
+            )
+            self._spilled.execute("CREATE INDEX spilled_product_id ON spilled (product_id)")
+        # Maps each product_id to the set of ids of the payments for it held in memory.
+        self._by_product = {}
+
+    def _index(self, payment_id, record):
+        product_id = getattr(record, "product_id", None)
+        if product_id is not None:
+            try:
+                self._by_product[product_id].add(payment_id)
+            except KeyError:
+                self._by_product[product_id] = {payment_id}
+
+    def _unindex(self, payment_id, record):
+        product_id = getattr(record, "product_id", None)
+        ids = self._by_product.get(product_id)
+        if ids is not None:
+            ids.discard(payment_id)
+            if not ids:
+                del self._by_product[product_id]
+
+    def __setitem__(self, payment_id, payment):
+        record = to_record(payment)
+        old = self._memory.get(payment_id)
+        if old is not None:
+            self._unindex(payment_id, old)
+        elif self._spilled is not None:
+            # A payment archived again must not leave an older copy behind on disk.
+            self._unspill(payment_id)
+        self._memory[payment_id] = record
+        self._index(payment_id, record)
+        if self._spilled is not None:
+            while len(self._memory) > self.window:
+                self._spill_oldest()
+
+    def _spill_oldest(self):
+        payment_id = next(iter(self._memory))
+        record = self._memory.pop(payment_id)
+        self._unindex(payment_id, record)
+        self._spilled.execute(
+            "INSERT INTO spilled VALUES (?, ?, ?, ?)",
+            (payment_id, record.payment_type, getattr(record, "product_id", None), json.dumps(record)),
+        )
+        self._spilled_count += 1
+
+    def _read_spilled(self, payment_id):
+        """
+        :return: The spilled record of a payment, or None if it has not been spilled.
+        """
+        row = self._spilled.execute(
+            "SELECT payment_type, record FROM spilled WHERE payment_id = ?", (payment_id,)
+        ).fetchone()
+        return None if row is None else from_values(row[0], json.loads(row[1]))
+
+    def _unspill(self, payment_id):
+        """
+        Remove the spilled record of a payment.
+
+        :return: The record removed, or None if it had not been spilled.
+        """
+        record = self._read_spilled(payment_id)
+        if record is not None:
+            self._spilled.execute("DELETE FROM spilled WHERE payment_id = ?", (payment_id,))
+            self._spilled_count -= 1
+        return record
+
+    def __getitem__(self, payment_id):
+        try:
+            return self._memory[payment_id]
+        except KeyError:
+            if self._spilled is None:
+                raise
+        record = self._read_spilled(payment_id)
+        if record is None:
+            raise KeyError(payment_id)
+        return record
+
+    def __delitem__(self, payment_id):
+        self.pop(payment_id)
+
+    def __contains__(self, payment_id):
+        if payment_id in self._memory:
+            return True
+        return self._spilled is not None and self._spilled.execute(
+            "SELECT 1 FROM spilled WHERE payment_id = ?", (payment_id,)
+        ).fetchone() is not None
+
+    def pop(self, payment_id, *default):
+        # Overridden since the processor pops every successful payment from failed_orders, and the generic version
+        # would raise and catch a KeyError each time.
+        if payment_id in self._memory:
+            record = self._memory.pop(payment_id)
+            self._unindex(payment_id, record)
+            return record
+        record = None if self._spilled is None else self._unspill(payment_id)
+        if record is None:
+            if default:
+                return default[0]
+            raise KeyError(payment_id)
+        return record
+
+    def __iter__(self):
+        # Spilled records are always older than those in memory, so yield them first.
+        if self._spilled is not None:
+            # Read a page of ids at a time, so neither a long list nor an open cursor is held while iterating.
+            last = -1
+            while True:
+                page = [row[0] for row in self._spilled.execute(
+                    "SELECT payment_id FROM spilled WHERE payment_id > ? ORDER BY payment_id LIMIT 1000", (last,)
+                )]
+                if not page:
+                    break
+                yield from page
+                last = page[-1]
+        yield from list(self._memory)
+
+    def __len__(self):
+        return len(self._memory) + self._spilled_count
+
+    def clear(self):
+        self._memory.clear()
+        self._by_product.clear()
+        if self._spilled is not None:
+            self._spilled.execute("DELETE FROM spilled")
+            self._spilled_count = 0
+
+    def ids_for_product(self, product_id):
+        """
+        Get the ids of every archived payment for a product, using the product_id index.
+
+        :param product_id: The product to look up.
+        :return: A list of payment ids, in ascending order.
+        """
+        ids = list(self._by_product.get(product_id, ()))
+        if self._spilled is not None:
+            ids.extend(row[0] for row in self._spilled.execute(
+                "SELECT payment_id FROM spilled WHERE product_id = ?", (product_id,)
+            ))
+        return sorted(ids)
+
+    def products(self):
+        """
+        :return: A list of every distinct product_id among the archived payments.
+        """
+        products = dict.fromkeys(self._by_product)
+        if self._spilled is not None:
+            products.update(dict.fromkeys(row[0] for row in self._spilled.execute(
+                "SELECT DISTINCT product_id FROM spilled WHERE product_id IS NOT NULL"
+            )))
+        return list(products)
+
+    def __reduce_ex__(self, protocol):
+        # The spill file belongs to this archive alone, so a windowed archive cannot be sent to another process.  It
+        # is sent as a new, empty archive instead, which is all the worker processes of Processor.process_payments
+        # need, since they never touch the archives of the database they are given.
+        if self._spilled is not None:
+            return OrderArchive, ()
+        return super().__reduce_ex__(protocol)
+
+    def close(self):
+        """
+        Close the spill file, if there is one.  The archive may not be used afterwards.
+        """
+        if self._spilled is not None:
+            self._spilled.close()
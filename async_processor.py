@@ -0,0 +1,220 @@
+"""
+Define an asynchronous variant of the processor.  Several processor operations, such as sending emails and generating
+packing slips, stand in for calls to slow external systems.  The regular processor waits on each of these in turn, so
+the time to process a batch is the sum of every single wait.  The async processor instead keeps many payments in
+flight at once, so that their waits overlap.
+
+The steps of a single payment are still run in exactly the order given by its action plan.  Operations that talk to
+external systems are deferred rather than run immediately, and every deferred operation of a phase is awaited before
+the next phase of that payment begins, so the begin / middle / end ordering guarantees of the style guide in
+payment.py still hold for each payment.  Within a single phase, deferred operations may overlap with each other, which
+is why the style guide asks that steps within a phase not depend on one another's order.
+
+Like Processor, the async processor takes an optional Instrumentation and IdempotencyIndex.  Phases are timed from
+their start until their deferred operations finish, and deferred operations are timed while they are carried out.  Of
+several payments with the same idempotency key, only one is in flight at a time: the others wait for it to finish,
+and are then skipped if it succeeded, or processed if it failed.
+"""
+
+import asyncio
+import contextvars
+import time
+
+from payment import Payment
+from plan import PHASES, compile_plan
+from processor import BaseProcessor
+
+# The list collecting deferred operations for the payment phase currently running in this task, or None when not
+# inside an async processing phase.
+_deferred = contextvars.ContextVar("deferred", default=None)
+
+class AsyncProcessor(BaseProcessor):
+    """
+    Processor that overlaps the external operations of many payments at once.  At most concurrency payments are
+    processed at a time, and payments are pulled from the input through a bounded queue, so a slow backend will stall
+    the producer rather than let an unbounded number of payments pile up in memory.  It shares the actions of
+    Processor, but not its synchronous ways of processing payments, and code that drives a processor synchronously,
+    such as retry.py and checkpoint.py, raises a TypeError if given one.
+    """
+    # The actions carried out as deferred operations, which are timed by the processor rather than by attach.
+    deferred_actions = (
+        "generate_packing_slip", "generate_commission", "generate_royalty_packing_slip", "send_membership_email"
+    )
+
+    def __init__(self, database, sink=None, concurrency=16, queue_size=None, instrumentation=None, idempotency=None):
+        """
+        :param database: A reference to the previously created system database.
+        :param sink: The ActionSink that will receive a record of every action taken.  Defaults to a PrintSink.
+        :param concurrency: The maximum number of payments that will be in flight at once.
+        :param queue_size: The maximum number of payments read ahead of the ones in flight.  Defaults to concurrency.
+        :param instrumentation: If given, an Instrumentation, as for Processor.
+        :param idempotency: If given, an IdempotencyIndex, as for Processor.
+        """
+        super().__init__(database, sink, instrumentation, idempotency)
+        if concurrency < 1:
+            raise ValueError("Invalid argument: concurrency must be at least 1.")
+        self.concurrency = concurrency
+        self.queue_size = concurrency if queue_size is None else queue_size
+        # Maps the idempotency key of each payment in flight to an event set when it finishes.
+        self._in_flight = {}
+
+    def run(self, arg):
+        """
+        Convenience wrapper to process payments from synchronous code.  Takes the same argument as process_payments.
+        """
+        return asyncio.run(self.process_payments(arg))
+
+    async def process_payments(self, arg):
+        """
+        Process either a single payment, or an iterable of several
+        :param arg: Either a single Payment object, or an iterable or async iterable of such objects
+        :return: Either a list of payments that failed, in the order they were given, if an iterable was given, or a
+        single payment that failed, if only one was provided.  May be an empty list or none if there were no failures.
+        """
+        if isinstance(arg, Payment):
+            return await self.process_payment(arg)
+
+        queue = asyncio.Queue(self.queue_size)
+        failed_orders = []
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, payment = item
+                if await self.process_payment(payment) is not None:
+                    failed_orders.append((index, payment))
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            index = 0
+            if hasattr(arg, "__aiter__"):
+                async for payment in arg:
+                    await queue.put((index, payment))
+                    index += 1
+            else:
+                for payment in arg:
+                    await queue.put((index, payment))
+                    index += 1
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for each in workers:
+                each.cancel()
+
+        self.flush()
+        failed_orders.sort(key=lambda item: item[0])
+        return [payment for _, payment in failed_orders]
+
+    async def process_payment(self, payment):
+        """
+        Process a single payment, awaiting the deferred operations of each phase before moving on to the next.
+        :param payment: The payment to process
+        :return: the payment, if processing failed, or None if it succeeded
+        """
+        key = None
+        if self.idempotency is not None:
+            key = await self._claim(payment)
+            if key is None:
+                self.sink.record(payment.payment_id, "duplicate_skipped")
+                return None
+        try:
+            return await self._process_claimed(payment, key)
+        finally:
+            if key is not None:
+                self._in_flight.pop(key).set()
+
+    async def _claim(self, payment):
+        """
+        Check a payment against the idempotency index, first waiting for any payment with the same key that is still
+        in flight to finish.
+
+        :return: The digest of the payment's key, now marked as in flight, or None if the payment is a duplicate.
+        """
+        while True:
+            key = self.idempotency.check(payment)
+            if key is None:
+                return None
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self._in_flight[key] = asyncio.Event()
+                return key
+            await in_flight.wait()
+
+    async def _process_claimed(self, payment, key):
+        self._begin_payment(payment)
+        plan = compile_plan(type(payment))
+        histograms = None if self.instrumentation is None else self.instrumentation.phase_histograms(plan)
+        clock = time.perf_counter_ns
+        try:
+            for phase in PHASES:
+                start = clock()
+                deferred = []
+                _deferred.set(deferred)
+                try:
+                    try:
+                        for action in plan.phase(phase):
+                            action(payment, self)
+                    except Exception:
+                        # Operations deferred earlier in a failing phase are never started.
+                        for each in deferred:
+                            each.close()
+                        raise
+                    if deferred:
+                        await asyncio.gather(*deferred)
+                finally:
+                    if histograms is not None:
+                        histograms[phase].record(clock() - start)
+        except Exception as e:
+            return self._fail_payment(payment, e)
+        else:
+            self._complete_payment(payment, key)
+            return None
+        finally:
+            _deferred.set(None)
+
+    async def perform(self, operation, *args):
+        """
+        Carry out a deferred external operation.  By default the blocking implementation inherited from BaseProcessor is
+        run in a worker thread.  Override this to call into a real async backend instead.
+
+        :param operation: The bound BaseProcessor method implementing the operation.
+        :param args: The arguments to the operation.
+        """
+        await asyncio.to_thread(operation, *args)
+
+    async def _perform_timed(self, operation, *args):
+        histogram = self.instrumentation.actions.get(operation.__name__)
+        start = time.perf_counter_ns()
+        try:
+            await self.perform(operation, *args)
+        finally:
+            if histogram is not None:
+                histogram.record(time.perf_counter_ns() - start)
+
+    def _defer(self, operation, *args):
+        """
+        Defer an external operation to the end of the current phase, or run it immediately if not called from within
+        an async processing phase.
+        """
+        deferred = _deferred.get()
+        if deferred is None:
+            operation(*args)
+        elif self.instrumentation is None:
+            deferred.append(self.perform(operation, *args))
+        else:
+            deferred.append(self._perform_timed(operation, *args))
+
+    def generate_packing_slip(self, payment):
+        self._defer(super().generate_packing_slip, payment)
+
+    def generate_commission(self, payment):
+        self._defer(super().generate_commission, payment)
+
+    def generate_royalty_packing_slip(self, payment):
+        self._defer(super().generate_royalty_packing_slip, payment)
+
+    def send_membership_email(self, payment):
+        self._defer(super().send_membership_email, payment)
@@ -0,0 +1,262 @@
+"""
+Define an opt-in batch mode for actions that are cheaper to send downstream in bulk than one payment at a time.  The
+processor records one packing slip per payment, even when a batch holds many payments for the same address, and every
+one of those becomes a separate call to the warehouse.  Likewise every commission becomes a separate payout to its
+agent, and every membership email a separate call to the mail gateway.  In batch mode, such actions are held back and
+consolidated by batchers, which send out one combined action for many payments when the batch ends.
+
+Batch mode is enabled by wrapping the processor's sink in a BatchingSink, e.g.
+
+    processor = Processor(database, BatchingSink(PrintSink(), [PackingSlipBatcher(), CommissionBatcher()]))
+
+The BatchingSink passes every record straight through to the wrapped sink, except those for the actions its batchers
+take, which are staged per payment.  Staged records are handed to the batchers only once their payment completes, and
+thrown away if it fails, so a failed payment never ships.  Consolidated actions are recorded to the wrapped sink when
+the sink is flushed, which the processor does at the end of every call to process_payments, or after every window
+payments if a window is given.
+
+Consolidated records are made for many payments at once, so their payment_id is None.
+"""
+
+import json
+import threading
+
+from sink import ActionSink
+
+class Batcher:
+    """
+    Base class for all batchers.  Subclasses set actions to the names of the actions they take, and implement
+    add_payment and drain.
+    """
+    actions = ()
+
+    def add_payment(self, payment_id, records):
+        """
+        Take the staged records of a payment that has completed.
+
+        :param payment_id: The id of the payment.
+        :param records: A list of the (payment_id, action, fields) records of the payment for this batcher's actions,
+        in the order they were recorded.
+        """
+        raise NotImplementedError
+
+    def drain(self):
+        """
+        End the current batch.
+
+        :return: A list of the (payment_id, action, fields) records to send out for the batch.
+        """
+        raise NotImplementedError
+
+class BatchingSink(ActionSink):
+    """
+    Sink that holds back the actions taken by its batchers, and records their consolidated actions to another sink
+    when flushed.  Safe to record to from multiple threads.
+    """
+    def __init__(self, sink, batchers, window=None):
+        """
+        :param sink: The sink to record every action to.
+        :param batchers: A list of Batchers.  Each action may be taken by at most one of them.
+        :param window: If given, end the batch after this many payments have completed, as well as when flushed.
+        """
+        self.sink = sink
+        self.batchers = list(batchers)
+        self.window = window
+        self._routes = {}
+        for batcher in self.batchers:
+            for action in batcher.actions:
+                if action in self._routes:
+                    raise ValueError(f"Invalid argument: action {action} is taken by more than one batcher.")
+                self._routes[action] = batcher
+        self._staged = {}
+        self._completed = 0
+        self._lock = threading.RLock()
+
+    def record(self, payment_id, action, fields=()):
+        if action in self._routes:
+            with self._lock:
+                self._staged.setdefault(payment_id, []).append((payment_id, action, fields))
+            return
+        if action == "completed":
+            self._commit(payment_id)
+        elif action == "failed":
+            with self._lock:
+                self._staged.pop(payment_id, None)
+        self.sink.record(payment_id, action, fields)
+
+    def _commit(self, payment_id):
+        with self._lock:
+            staged = self._staged.pop(payment_id, None)
+            if staged is not None:
+                for batcher in self.batchers:
+                    records = [record for record in staged if self._routes[record[1]] is batcher]
+                    if records:
+                        batcher.add_payment(payment_id, records)
+            self._completed += 1
+            if self.window is not None and self._completed >= self.window:
+                self._drain()
+
+    def _drain(self):
+        for batcher in self.batchers:
+            for record in batcher.drain():
+                self.sink.record(*record)
+        self._completed = 0
+
+    def flush(self):
+        """
+        End the current batch, recording every consolidated action, then flush the wrapped sink.  Records of payments
+        that have not yet completed or failed stay staged.
+        """
+        with self._lock:
+            self._drain()
+        self.sink.flush()
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+class PackingSlipBatcher(Batcher):
+    """
+    Consolidates packing slips into one slip per shipping address and department, listing every product bound for
+    that address.  Video add-ons are listed with the product of the payment they were added to, on its regular
+    (shipping department) packing slip.  Records a consolidated_packing_slip action for each slip.
+    """
+    actions = ("packing_slip", "royalty_packing_slip", "video_addon")
+    departments = {"packing_slip": "shipping", "royalty_packing_slip": "royalty"}
+
+    def __init__(self):
+        # Maps (department, shipping_address) to a list of (payment_id, product_id, add_ons) items.
+        self._slips = {}
+        self._unattached = []
+
+    def add_payment(self, payment_id, records):
+        add_ons = tuple(fields[0] for _, action, fields in records if action == "video_addon")
+        attached = False
+        for _, action, fields in records:
+            if action == "video_addon":
+                continue
+            department = self.departments[action]
+            product_id, shipping_address = fields
+            item_add_ons = ()
+            if department == "shipping" and not attached:
+                item_add_ons, attached = add_ons, True
+            self._slips.setdefault((department, shipping_address), []).append((payment_id, product_id, item_add_ons))
+        if add_ons and not attached:
+            # There is no slip to attach the add-ons to, so they are sent out unconsolidated.
+            self._unattached += [record for record in records if record[1] == "video_addon"]
+
+    def drain(self):
+        records = [
+            (None, "consolidated_packing_slip", (department, shipping_address, tuple(items)))
+            for (department, shipping_address), items in self._slips.items()
+        ]
+        records += self._unattached
+        self._slips = {}
+        self._unattached = []
+        return records
+
+class CommissionBatcher(Batcher):
+    """
+    Consolidates commissions into one settlement per agent, itemizing the commission of each payment.  Commissions
+    are summed as whole cents, so a settlement is always exactly the sum of its items, with no floating point error
+    however many there are.  Records a commission_settlement action for each agent.
+    """
+    actions = ("commission",)
+
+    def __init__(self):
+        # Maps agent to a list of (payment_id, commission) items, and to the total of those items in cents.
+        self._items = {}
+        self._cents = {}
+
+    def add_payment(self, payment_id, records):
+        for _, _, (agent, commission) in records:
+            self._items.setdefault(agent, []).append((payment_id, commission))
+            self._cents[agent] = self._cents.get(agent, 0) + round(commission * 100)
+
+    def drain(self):
+        records = [
+            (None, "commission_settlement", (agent, self._cents[agent] / 100, tuple(items)))
+            for agent, items in self._items.items()
+        ]
+        self._items = {}
+        self._cents = {}
+        return records
+
+class MembershipNotificationBatcher(Batcher):
+    """
+    Collapses the membership emails of a batch into one notification per member, listing every activation and upgrade
+    of theirs, and sends all of the notifications through a transport in one bulk call when the batch ends.  Records
+    a membership_notification action for each notification sent.
+    """
+    actions = ("activation_email", "upgrade_email")
+    events = {"activation_email": "activation", "upgrade_email": "upgrade"}
+
+    def __init__(self, transport):
+        """
+        :param transport: The transport to send notifications through, e.g. a FileTransport.
+        """
+        self.transport = transport
+        # Maps member_id to a list of (event, membership_id) tuples.
+        self._events = {}
+
+    def add_payment(self, payment_id, records):
+        for _, action, (member_id, membership_id) in records:
+            events = self._events.setdefault(member_id, [])
+            event = (self.events[action], membership_id)
+            # The same event for the same member is only notified once.
+            if event not in events:
+                events.append(event)
+
+    def drain(self):
+        notifications = [(member_id, tuple(events)) for member_id, events in self._events.items()]
+        self._events = {}
+        if notifications:
+            self.transport.send(notifications)
+        return [(None, "membership_notification", notification) for notification in notifications]
+
+class NotificationTransport:
+    """
+    Base class for transports, which deliver membership notifications.  Subclasses must implement send.
+    """
+    def send(self, notifications):
+        """
+        Deliver a batch of notifications.
+
+        :param notifications: A list of (member_id, events) tuples, where events is a tuple of (event,
+        membership_id) tuples and event is either 'activation' or 'upgrade'.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class MemoryTransport(NotificationTransport):
+    """
+    Transport that keeps every batch of notifications in memory, in the list attribute batches.
+    """
+    def __init__(self):
+        self.batches = []
+
+    def send(self, notifications):
+        self.batches.append(list(notifications))
+
+class FileTransport(NotificationTransport):
+    """
+    Transport that stands in for a mail gateway by writing each notification to a file as a JSON line.  Close the
+    transport when finished with it.
+    """
+    def __init__(self, path):
+        """
+        :param path: The path of the file to write notifications to.  The file is overwritten.
+        """
+        self.file = open(path, "w")
+
+    def send(self, notifications):
+        self.file.write("".join(
+            json.dumps({"member_id": member_id, "events": [list(event) for event in events]}) + "\n"
+            for member_id, events in notifications
+        ))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
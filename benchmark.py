@@ -0,0 +1,219 @@
+"""
+Benchmark the processor against synthetic workloads.  A seeded generator produces a configurable mix of
+PhysicalProduct, Book, Video and Membership payments, which are then streamed through Processor.process_payments.  For
+each workload size this reports:
+
+    throughput      payments per second through process_payments, with a NullSink so output is not measured
+    latency         percentiles of the time spent in each phase (process_begin, process_middle, process_end) of a
+                    single payment for each payment class, and in each processor action, measured over a sample of the
+                    workload with an Instrumentation (see instrumentation.py)
+    memory          peak resident memory of the run, which includes the archive of processed payments.  Each size is
+                    run in a fresh process of its own, so that the peak of one size is not carried over to the next
+
+Results can be saved to a JSON file, and a previous results file can be given to compare against, so that performance
+regressions between versions can be spotted.  Use the same seed, mix and sizes for results that are to be compared.
+
+Usage:
+    python benchmark.py --sizes 1000 100000 --output new.json --compare old.json
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
+import payment
+from archive import OrderArchive
+from database import Database
+from instrumentation import Instrumentation
+from processor import Processor
+from sink import NullSink
+
+DEFAULT_MIX = {"PhysicalProduct": 4, "Book": 3, "Video": 2, "Membership": 1}
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+# Products named in the lookup tables of Database are mixed in, so that every rule gets exercised.
+_PRODUCTS = ["pants", "apple", "laptop"] + [f"product_{i}" for i in range(200)]
+_BOOKS = [f"book_{i}" for i in range(200)]
+_VIDEOS = ["Learning to Ski"] + [f"video_{i}" for i in range(50)]
+_AGENTS = [f"agent_{i}" for i in range(100)] + [None]
+_ADDRESSES = [f"{i} Main Street" for i in range(1000)]
+
+def generate_payments(database, count, mix=None, seed=0):
+    """
+    Lazily generate a reproducible synthetic workload of payments.
+
+    :param database: The database to construct the payments with.
+    :param count: The number of payments to generate.
+    :param mix: A dict mapping payment type names to relative weights.  Defaults to DEFAULT_MIX.
+    :param seed: The seed for the random number generator.  The same seed and mix always give the same payments.
+    :return: A generator yielding each payment.
+    """
+    mix = DEFAULT_MIX if mix is None else mix
+    rng = random.Random(seed)
+    names = list(mix)
+    cum_weights = list(itertools.accumulate(mix.values()))
+    for _ in range(count):
+        # Each type is drawn as its payment is generated, so that no list of the whole workload is ever built.
+        payment_type = rng.choices(names, cum_weights=cum_weights)[0]
+        value = round(rng.uniform(0.5, 2500.0), 2)
+        if payment_type == "Membership":
+            yield payment.Membership(
+                database=database,
+                value=value,
+                membership_payment_type=rng.choice(("activation", "upgrade")),
+                membership_id=rng.choice(("streaming_service", "cleaning_service", "gym")),
+                member_id=f"member_{rng.randrange(100000)}",
+            )
+        else:
+            cls = getattr(payment, payment_type)
+            catalog = {"Book": _BOOKS, "Video": _VIDEOS}.get(payment_type, _PRODUCTS)
+            yield cls(
+                database=database,
+                value=value,
+                product_id=rng.choice(catalog),
+                shipping_address=rng.choice(_ADDRESSES),
+                agent=rng.choice(_AGENTS),
+            )
+
+def private_database():
+    """
+    :return: A database with archives of its own, rather than the archives every Database shares through the class,
+    so that the benchmark neither measures nor empties archives that belong to anything else.
+    """
+    database = Database()
+    database.processed_orders = OrderArchive()
+    database.failed_orders = OrderArchive()
+    database.dead_letters = OrderArchive()
+    return database
+
+def run_benchmark(size, mix=None, seed=0, latency_sample=100000):
+    """
+    Run the benchmark for a single workload size.
+
+    :param size: The number of payments in the workload.
+    :param mix: A dict mapping payment type names to relative weights.  Defaults to DEFAULT_MIX.
+    :param seed: The seed for generating the workload.
+    :param latency_sample: The maximum number of payments to measure phase latency over.
+    :return: A dict of results.
+    """
+    database = private_database()
+    processor = Processor(database, NullSink())
+
+    # Payments are generated as they are processed, so that the workload itself never needs to fit in memory.
+    start = time.perf_counter()
+    failed = processor.process_payments(generate_payments(database, size, mix, seed))
+    elapsed = time.perf_counter() - start
+
+    # Latency is measured in a separate pass, so that the instrumentation does not slow the throughput measurement.
+    peak_rss_mb = peak_memory_mb()
+    database = private_database()
+    instrumentation = Instrumentation()
+    instrumented = Processor(database, NullSink(), instrumentation)
+    instrumented.process_payments(generate_payments(database, min(size, latency_sample), mix, seed))
+    latency = instrumentation.snapshot()
+
+    return {
+        "size": size,
+        "seconds": elapsed,
+        "payments_per_second": size / elapsed if elapsed else None,
+        "failed": len(failed),
+        "phase_latency": latency["phases"],
+        "action_latency": latency["actions"],
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+def run_isolated(size, mix=None, seed=0, latency_sample=100000):
+    """
+    Run the benchmark for a single workload size in a fresh process, whose peak memory is that of this size alone.
+    The process is spawned rather than forked, so that it does not start out with the memory of this one.
+
+    :return: A dict of results, see run_benchmark.
+    """
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(run_benchmark, (size, mix, seed, latency_sample))
+
+def peak_memory_mb():
+    """
+    :return: The peak resident memory of this process so far, in megabytes.  This is the peak over the whole life of
+    the process, see run_isolated.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, but kilobytes everywhere else.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def format_latency(stats):
+    """
+    :param stats: A histogram summary, see LatencyHistogram.snapshot.
+    :return: The percentiles of the summary as a single line of text.
+    """
+    return "  ".join(f"{key[:-3]} {stats[key]:8.2f}us" for key in ("p50_us", "p90_us", "p99_us", "max_us"))
+
+def compare(results, baseline):
+    """
+    Print a comparison of throughput between two sets of results, matching runs by size.
+    """
+    old = {run["size"]: run for run in baseline["runs"]}
+    print("Comparison with baseline:")
+    for run in results["runs"]:
+        if run["size"] in old and old[run["size"]]["payments_per_second"]:
+            ratio = run["payments_per_second"] / old[run["size"]]["payments_per_second"]
+            print(f" | size {run['size']:>10}: {ratio:6.2f}x baseline throughput")
+        else:
+            print(f" | size {run['size']:>10}: no baseline")
+
+def parse_mix(text):
+    """
+    Parse a mix given on the command line, e.g. 'Book=2,Membership=1'.
+    """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown payment type {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the payment processor on synthetic workloads.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Workload sizes to run.")
+    parser.add_argument("--mix", type=parse_mix, default=None, help="Payment type weights, e.g. Book=2,Membership=1")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the workload generator.")
+    parser.add_argument("--latency-sample", type=int, default=100000, help="Payments to measure latency over.")
+    parser.add_argument("--output", help="Save the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against results previously saved to this JSON file.")
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seed": args.seed,
+        "mix": args.mix or DEFAULT_MIX,
+        "runs": [],
+    }
+    for size in args.sizes:
+        run = run_isolated(size, args.mix, args.seed, args.latency_sample)
+        results["runs"].append(run)
+        print(f"Size {size}: {run['payments_per_second']:,.0f} payments/sec, peak memory {run['peak_rss_mb']:.1f} MB")
+        for name, phases in run["phase_latency"].items():
+            for phase, stats in phases.items():
+                print(f" | {name:<15} {phase:<15} {format_latency(stats)}")
+        for name, stats in run["action_latency"].items():
+            if stats["count"]:
+                print(f" | {name:<31} {format_latency(stats)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Define a fixed-layout binary format for batches of payments, so that payments can be handed between processes without
+pickling.  Pickling a payment builds a whole new object on the other side, and every payment drags its reference to
+the database along with it.  A binary batch is instead a single flat buffer, which can be written into shared memory or
+a memory-mapped file, and read by any number of other processes without being deserialized at all.
+
+Every payment in a batch must be of the same class, and is stored as one fixed size row, with a column for each of
+payment_fields of the class.  Each column is stored as one of:
+
+    q   a 64 bit integer, if every value in the column is an int
+    d   a 64 bit float, if every value in the column is an int or float
+    s   a 32 bit index into the string table of the batch, or 0xFFFFFFFF for None, otherwise
+
+Strings are dictionary encoded: each distinct string is stored just once, in the string table in the header of the
+batch, however many rows share it.  The header is read once when a batch is opened.  After that, reading a payment from
+the batch builds nothing but a small view holding its position, and each field is only unpacked from the buffer when it
+is read.  Views behave like the payment they were made from as far as the processor is concerned, so a whole batch can
+be processed directly, e.g. in a worker process:
+
+    batch = open_shared(name, database)
+    failed = processor.process_payments(batch)
+    batch.close()
+
+Views are read only, and read every field from the buffer of their batch, so they cannot be used once their batch is
+closed.  Archiving a view copies its values, so views may be archived as usual, and pickling a view pickles the payment
+it stands in for, so views may also be given to Processor.process_payments with workers.  The processor itself hands
+payments to its worker processes as binary batches in shared memory.
+"""
+
+import json
+import mmap
+import struct
+from multiprocessing import shared_memory
+
+from payment import _restore_payment, declared_class, find_payment_class, payment_fields
+
+MAGIC = b"KPB1"
+NO_STRING = 0xFFFFFFFF
+
+_header_prefix = struct.Struct("<4sI")
+_view_classes = {}
+
+def _column_kind(values):
+    if all(type(value) is int for value in values):
+        return "q"
+    if all(type(value) in (int, float) for value in values):
+        return "d"
+    if all(value is None or isinstance(value, str) for value in values):
+        return "s"
+    raise ValueError("Invalid argument: binary batch columns may only hold ints, floats, or strings and None.")
+
+def encode_batch(payments):
+    """
+    Encode payments as a binary batch.
+
+    :param payments: A non-empty sequence of payments, all of the same class.
+    :return: The batch, as bytes.
+    """
+    if not payments:
+        raise ValueError("Invalid argument: cannot encode an empty batch.")
+    cls = declared_class(type(payments[0]))
+    if any(declared_class(type(payment)) is not cls for payment in payments):
+        raise ValueError("Invalid argument: every payment in a binary batch must be of the same class.")
+
+    fields = payment_fields(cls)
+    columns = [[getattr(payment, field) for payment in payments] for field in fields]
+    kinds = "".join(_column_kind(column) for column in columns)
+
+    strings = {}
+    for kind, column in zip(kinds, columns):
+        if kind == "s":
+            column[:] = [NO_STRING if value is None else strings.setdefault(value, len(strings)) for value in column]
+
+    header = json.dumps({
+        "type": cls.__name__,
+        "fields": fields,
+        "kinds": kinds,
+        "count": len(payments),
+        "strings": list(strings),
+    }).encode()
+    # Pad the header so that rows start on an 8 byte boundary.
+    header += b" " * (-(_header_prefix.size + len(header)) % 8)
+
+    row = struct.Struct("<" + kinds.replace("s", "I"))
+    data = bytearray(_header_prefix.size + len(header) + row.size * len(payments))
+    _header_prefix.pack_into(data, 0, MAGIC, len(header))
+    data[_header_prefix.size:_header_prefix.size + len(header)] = header
+    offset = _header_prefix.size + len(header)
+    for values in zip(*columns):
+        row.pack_into(data, offset, *values)
+        offset += row.size
+    return bytes(data)
+
+def write_shared(payments, name=None):
+    """
+    Encode payments as a binary batch in a new block of shared memory.
+
+    :param payments: A non-empty sequence of payments, all of the same class.
+    :param name: The name of the block to create, or None for a unique name.
+    :return: The SharedMemory holding the batch.  Its name can be given to open_shared in another process.  The
+    creator is responsible for unlinking it once every reader is finished.
+    """
+    data = encode_batch(payments)
+    block = shared_memory.SharedMemory(name, create=True, size=len(data))
+    block.buf[:len(data)] = data
+    return block
+
+def write_file(path, payments):
+    """
+    Encode payments as a binary batch in a file, to be read with open_file.
+    """
+    with open(path, "wb") as f:
+        f.write(encode_batch(payments))
+
+def open_shared(name, database):
+    """
+    Open a binary batch held in shared memory, created by write_shared.
+
+    :param name: The name of the shared memory block.
+    :param database: A reference to the system database, for the payments to use.
+    :return: A BatchView.  Close it when finished with it.
+    """
+    block = shared_memory.SharedMemory(name)
+    return BatchView(block.buf, database, block.close)
+
+def open_file(path, database):
+    """
+    Open a binary batch held in a file, by memory mapping it.
+
+    :param path: The path of a file written by write_file.
+    :param database: A reference to the system database, for the payments to use.
+    :return: A BatchView.  Close it when finished with it.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return BatchView(mapped, database, mapped.close)
+
+class BatchView:
+    """
+    A read only sequence of payment views over a binary batch.  Indexing or iterating over it gives views, which read
+    each of their fields straight from the buffer.
+    """
+    def __init__(self, buffer, database, on_close=None):
+        """
+        :param buffer: A buffer holding a batch, as made by encode_batch.
+        :param database: A reference to the system database, for the payments to use.
+        :param on_close: A function to call once the buffer has been released by close.
+        """
+        self.buffer = memoryview(buffer)
+        self.database = database
+        self._on_close = on_close
+        magic, header_size = _header_prefix.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Invalid argument: buffer does not hold a binary payment batch.")
+        header = json.loads(bytes(self.buffer[_header_prefix.size:_header_prefix.size + header_size]))
+
+        self.payment_class = find_payment_class(header["type"])
+        self.strings = header["strings"]
+        self.count = header["count"]
+        self._start = _header_prefix.size + header_size
+        self._view_class = view_class(self.payment_class, tuple(header["fields"]), header["kinds"])
+        self._row_size = self._view_class._row_size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self._view_class(self, self._start + index * self._row_size)
+
+    def __iter__(self):
+        view_cls, row_size = self._view_class, self._row_size
+        for offset in range(self._start, self._start + self.count * self._row_size, row_size):
+            yield view_cls(self, offset)
+
+    def close(self):
+        """
+        Release the buffer.  Neither the batch nor any of its views may be used afterwards.
+        """
+        self.buffer.release()
+        if self._on_close is not None:
+            self._on_close()
+
+class PaymentView:
+    """
+    Base class of the view classes made by view_class.  A view stands in for a single payment stored in a batch.
+    """
+    __slots__ = ("_batch", "_offset")
+
+    def __init__(self, batch, offset):
+        self._batch = batch
+        self._offset = offset
+
+    @property
+    def database(self):
+        return self._batch.database
+
+    def __reduce__(self):
+        # A view cannot outlive its buffer, so pickle it as the payment it stands in for.
+        cls = self._layout_of
+        state = {field: getattr(self, field) for field in self._fields}
+        state["database"] = self.database
+        return _restore_payment, (cls, state)
+
+    def __repr__(self):
+        return f"<{type(self).__name__} view of payment {self.payment_id}>"
+
+def _number_getter(unpack, offset):
+    def get(self):
+        return unpack(self._batch.buffer, self._offset + offset)[0]
+    return property(get)
+
+def _string_getter(unpack, offset):
+    def get(self):
+        code = unpack(self._batch.buffer, self._offset + offset)[0]
+        return None if code == NO_STRING else self._batch.strings[code]
+    return property(get)
+
+def view_class(cls, fields, kinds):
+    """
+    Get the view class for payments of a class stored with a given layout, creating it the first time it is needed.
+    View classes are declared as layouts of their payment class (see declared_class in payment.py), so views share
+    the action plan and archive record class of the payments they stand in for.
+
+    :param cls: The payment class.
+    :param fields: The names of the columns of the layout, in order.
+    :param kinds: The kind of each column, as a string of the characters q, d and s.
+    :return: The view class.
+    """
+    try:
+        return _view_classes[cls, fields, kinds]
+    except KeyError:
+        pass
+
+    namespace = {
+        "__slots__": (),
+        "_layout_of": cls,
+        "_fields": fields,
+        "_row_size": struct.calcsize("<" + kinds.replace("s", "I")),
+    }
+    offset = 0
+    for field, kind in zip(fields, kinds):
+        code = "I" if kind == "s" else kind
+        unpack = struct.Struct("<" + code).unpack_from
+        namespace[field] = (_string_getter if kind == "s" else _number_getter)(unpack, offset)
+        offset += struct.calcsize("<" + code)
+
+    view_cls = _view_classes[cls, fields, kinds] = type(cls.__name__, (PaymentView,), namespace)
+    view_cls.__qualname__ = cls.__qualname__
+    return view_cls
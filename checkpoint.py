@@ -0,0 +1,174 @@
+"""
+Define a progress log, so that a long run over a large input can be resumed after a crash rather than restarted from
+scratch.  Payments are identified by their ordinal, their position in the input, since a payment re-created from the
+same input on a rerun is given a new payment_id.  As each payment finishes, its ordinal and outcome are appended to the
+log, and a rerun over the same input skips every payment the log says has completed.
+
+Log writes are buffered and written out batch_size at a time, each batch followed by a single fsync, so keeping the log
+costs one disk sync per batch rather than per payment.  Before each batch is written the processor is flushed, so any
+payment the log records as finished has had all of its actions written out.  A crash loses at most the unwritten batch,
+whose payments are simply processed again on the rerun; pair the processor with an IdempotencyIndex (see
+idempotency.py) backed by an SQLiteKeyStore to also skip those.
+
+Since payments almost always finish in order, the log only needs to remember a watermark, below which every payment
+has finished, plus the finished payments above it.  Failed payments count as finished, so they never hold the watermark
+back; unless skip_failed is given, they are remembered separately so that a rerun processes them again.  Every
+checkpoint_interval payments the log is checkpointed: rewritten as just the watermark, the payments above it and the
+failures, so it stays small however long the run, and grows only with the number of failures.
+
+The log is a text file with one entry per line: 'w N' means every ordinal below N has finished, and 'c N' or 'f N'
+means ordinal N completed or failed.
+"""
+
+import os
+
+from processor import require_sync
+
+class ProgressLog:
+    """
+    A write-ahead log of which payments of an input have been processed.  Close the log when finished with it.
+    """
+    def __init__(self, path, batch_size=1000, checkpoint_interval=100000, skip_failed=False):
+        """
+        :param path: The path of the log file.  If it exists, progress is resumed from it, otherwise it is created.
+        :param batch_size: The number of entries to hold before writing them out.
+        :param checkpoint_interval: The number of entries to write between checkpoints.
+        :param skip_failed: If true, payments that failed are skipped on a rerun along with those that completed.
+        Otherwise they are processed again.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.skip_failed = skip_failed
+        self.watermark = 0
+        self._done = set()
+        # The ordinals of payments that failed, to be processed again on a rerun.  Empty if skip_failed is given.
+        self._failed = set()
+        self._buffer = []
+        self._since_checkpoint = 0
+        if os.path.exists(path):
+            self._load()
+        # Start every run from a checkpoint, so the log does not carry the entries of earlier runs.
+        self.file = None
+        self.checkpoint()
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                kind, _, ordinal = line.partition(" ")
+                # A crash may leave a torn final line, which is simply ignored.
+                if not ordinal.endswith("\n"):
+                    break
+                ordinal = int(ordinal)
+                if kind == "w":
+                    self.watermark = max(self.watermark, ordinal)
+                elif kind in ("c", "f"):
+                    self._mark_done(ordinal, kind == "c")
+        self._done = {ordinal for ordinal in self._done if ordinal >= self.watermark}
+
+    def _mark_done(self, ordinal, completed):
+        if completed or self.skip_failed:
+            self._failed.discard(ordinal)
+        else:
+            self._failed.add(ordinal)
+        if ordinal < self.watermark:
+            # A failure from an earlier run, processed again.
+            return
+        self._done.add(ordinal)
+        while self.watermark in self._done:
+            self._done.remove(self.watermark)
+            self.watermark += 1
+
+    def is_done(self, ordinal):
+        """
+        :param ordinal: The position of a payment in the input.
+        :return: True if the payment should be skipped, as a previous run has already processed it.
+        """
+        return (ordinal < self.watermark or ordinal in self._done) and ordinal not in self._failed
+
+    def record(self, ordinal, completed):
+        """
+        Record that a payment has finished.  The entry is held in memory until the next write.
+
+        :param ordinal: The position of the payment in the input.
+        :param completed: True if the payment completed, or False if it failed.
+        :return: True if the buffer is full, and flush should be called.
+        """
+        self._buffer.append(f"{'c' if completed else 'f'} {ordinal}\n")
+        self._mark_done(ordinal, completed)
+        return len(self._buffer) >= self.batch_size
+
+    def flush(self):
+        """
+        Write out every buffered entry, and sync them to disk.  Checkpoints the log if enough entries have been
+        written since the last checkpoint.
+        """
+        if not self._buffer:
+            return
+        self._since_checkpoint += len(self._buffer)
+        if self._since_checkpoint >= self.checkpoint_interval:
+            self._buffer = []
+            self.checkpoint()
+            return
+        self.file.write("".join(self._buffer))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._buffer = []
+
+    def checkpoint(self):
+        """
+        Replace the log with the current watermark, the finished payments above it and the failures to process
+        again.  The new log is written to a separate file and moved into place, so a crash during a checkpoint leaves
+        either the old log or the new one.
+        """
+        if self.file is not None:
+            self.file.close()
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(f"w {self.watermark}\n")
+            f.write("".join(f"c {ordinal}\n" for ordinal in sorted(self._done - self._failed)))
+            f.write("".join(f"f {ordinal}\n" for ordinal in sorted(self._failed)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        self.file = open(self.path, "a")
+        self._buffer = []
+        self._since_checkpoint = 0
+
+    def close(self):
+        """
+        Flush and close the log.  The log may not be used afterwards.
+        """
+        self.flush()
+        self.file.close()
+
+def iter_failures(processor, payments, progress):
+    """
+    The checkpointed equivalent of Processor.iter_failures.  Payments the progress log says have already been
+    processed are skipped, and every other payment is processed and recorded in the log.
+
+    :param processor: The processor to use.
+    :param payments: An iterable of Payment objects, the same input, in the same order, as any previous run.
+    :param progress: The ProgressLog for this input.
+    :return: A generator yielding each payment that failed, as soon as it fails.
+    """
+    require_sync(processor)
+    for ordinal, payment in enumerate(payments):
+        if progress.is_done(ordinal):
+            continue
+        result = processor.process_payment(payment)
+        if progress.record(ordinal, result is None):
+            processor.flush()
+            progress.flush()
+        if result is not None:
+            yield result
+    processor.flush()
+    progress.flush()
+
+def process_payments(processor, payments, progress):
+    """
+    The checkpointed equivalent of Processor.process_payments, for an iterable of payments.
+
+    :return: A list of the payments that failed.
+    """
+    return list(iter_failures(processor, payments, progress))
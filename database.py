@@ -2,18 +2,39 @@
 Define a database that will hold all manner of common and non-specific needed for payment processing.  This is
 intended to mimic what would in a real system be something more akin to an SQL database.  It should be constructed
 just once for the system.  As this is just a demonstration, it will not have persistence like a real database would.
+For a database that does, see sqlite_database.py.
 """
 
 from collections import defaultdict
 
+from archive import OrderArchive
+from id_allocator import BlockIdAllocator, MemoryLeaseSource
+
+class DefaultTable(defaultdict):
+    """
+    A defaultdict that returns its default for keys it does not contain without adding them.  Processing payments only
+    reads the lookup tables, so a plain defaultdict would fill up with an entry for every product ever looked up,
+    which could no longer be told apart from the products the table actually lists, e.g. by recompute.py.
+    """
+    def __missing__(self, key):
+        if self.default_factory is None:
+            raise KeyError(key)
+        return self.default_factory()
+
 class Database:
     """
     Object that mocks an ERP SQL database and holds varous bits of common information that will be used by the
     payment processor.  Data are implemented as class attributes / methods as this is intended to be a
     singleton. The database should be considered read only once instantiated from the perspective of payments,
-    though the processor will archive payments in the processed_orders and failed_orders dictionaries.
+    though the processor will archive payments in the processed_orders and failed_orders archives.  These hold compact
+    archive records rather than the payments themselves, see archive.py.  Any archive may be replaced by an
+    OrderArchive with a window before any payments are processed, to bound how many records are kept in memory.
+    Failed payments that have been retried too many times are moved to the dead_letters archive, see retry.py.
+
+    Payment IDs come from id_allocator, which is safe to call from many threads at once.  It may be replaced, e.g. with
+    one using a FileLeaseSource, before any payments are constructed, to keep IDs unique across processes and restarts.
     """
-    price_table = defaultdict(
+    price_table = DefaultTable(
         lambda: 9.99,
         {
             "pants": 45.50,
@@ -21,7 +42,7 @@ class Database:
             "laptop": 1299.00
         }
     )
-    commission_table = defaultdict(
+    commission_table = DefaultTable(
         lambda: .1,
         {
             "apple": 0.0,
@@ -31,11 +52,11 @@ class Database:
     video_addons = {
         "Learning to Ski": "First Aid"
     }
-    processed_orders = {}
-    failed_orders = {}
-    _next_id = -1
+    processed_orders = OrderArchive()
+    failed_orders = OrderArchive()
+    dead_letters = OrderArchive()
+    id_allocator = BlockIdAllocator(MemoryLeaseSource())
 
     @classmethod
     def get_next_id(cls):
-        cls._next_id += 1
-        return cls._next_id
+        return cls.id_allocator.next_id()
@@ -0,0 +1,240 @@
+"""
+Define a factory for constructing payments from raw records, such as rows read from a file or a queue.  Each payment
+class that may be constructed this way is registered with the factory by name, and on registration the factory
+compiles a spec for it: the complete set of kwargs its constructor requires, collected across the whole MRO with the
+same logic as helper_check_required_kwargs in payment.py.
+
+Every record is checked against that spec before any payment is constructed, so a bad record is rejected with an error
+naming everything wrong with it, rather than failing on the first missing kwarg halfway through a constructor.  A spec
+may also hold choices, the values allowed for some fields, such as membership_payment_type, so that the checks a
+constructor would make are made up front too.  Bulk construction checks every record in a batch before constructing
+any of them, so a bad batch is rejected before any of it is processed, or any payment IDs are used.
+
+Most constructors do nothing but assign each kwarg to the attribute of the same name.  For classes whose constructors
+are all known to be plain like this (see PLAIN_CONSTRUCTORS), the factory fills in a new payment directly, which is
+faster than running the chain of constructors.  Any class with a constructor of its own is constructed by calling it,
+since the style guide lets constructors fill and check kwargs of their own.
+
+Records may be dicts mapping kwargs to values, or tuples holding the values of a spec's fields, in order.  The
+database kwarg is always supplied by the factory.  String fields that repeat across many payments, such as product_id,
+are interned as payments are constructed (see symbols.py), so payments built by the factory share their strings.
+"""
+
+import payment
+import symbols
+from payment import collect_kwargs, payment_fields
+
+# Constructors known to do nothing but assign each of their required kwargs to the attribute of the same name, and,
+# for Payment, allocate a payment_id, mapped to the choices they check.  The spec of every class whose MRO includes one
+# of these constructors checks its choices, so filling a payment in directly never skips a check its constructor makes.
+PLAIN_CONSTRUCTORS = {
+    payment.Payment.__init__: {},
+    payment.PhysicalProduct.__init__: {},
+    payment.Membership.__init__: {"membership_payment_type": payment.MEMBERSHIP_PAYMENT_TYPES},
+}
+
+def _is_plain(cls, fields):
+    """
+    :return: True if a payment of cls can be filled in directly from its fields, instead of running its constructors.
+    """
+    for c in cls.mro()[:-1]:
+        if c.__dict__.get("__init__", payment.Payment.__init__) not in PLAIN_CONSTRUCTORS or c.filled_kwargs:
+            return False
+        if c is not payment.Payment and "__new__" in c.__dict__:
+            return False
+    return set(payment_fields(cls)) == set(fields) | {"payment_id"}
+
+class PaymentSpec:
+    """
+    The precompiled construction spec for a single payment class.
+    """
+    def __init__(self, cls, choices=None):
+        """
+        :param cls: The payment class (must conform to the style guide in payment.py) to compile a spec for.
+        :param choices: A dict mapping fields to the values they are allowed to take, in addition to those checked by
+        the constructors in PLAIN_CONSTRUCTORS.  Other fields may take any value.
+        """
+        all_kwargs, removed_kwargs = collect_kwargs(cls)
+        required = set(all_kwargs) - removed_kwargs - {"database"}
+
+        self.payment_class = cls
+        self.fields = tuple(sorted(required))
+        self.required = frozenset(required)
+        all_choices = {}
+        for c in reversed(cls.mro()[:-1]):
+            all_choices.update(PLAIN_CONSTRUCTORS.get(c.__dict__.get("__init__"), {}))
+        all_choices.update(choices or {})
+        self.choices = {field: frozenset(values) for field, values in all_choices.items()}
+        self.plain = _is_plain(cls, self.fields)
+        self._layout = cls.layout() if self.plain else None
+        self._interned = tuple(field for field in self.fields if field in symbols.INTERNED_FIELDS)
+        self._not_interned = tuple(field for field in self.fields if field not in symbols.INTERNED_FIELDS)
+
+    def check(self, record, strict=False):
+        """
+        Check a dict record against the spec.
+
+        :param record: A dict mapping kwargs to values.
+        :param strict: If true, also reject records holding fields that are not part of the spec.
+        :return: None if the record is valid, otherwise a message describing every problem with it.
+        """
+        if self.required.issubset(record.keys()) and not strict and not self.choices:
+            return None
+        problems = []
+        missing = self.required.difference(record.keys())
+        if missing:
+            problems.append(f"missing fields {sorted(missing)}")
+        if strict:
+            unexpected = set(record.keys()) - self.required - {"type"}
+            if unexpected:
+                problems.append(f"unexpected fields {sorted(unexpected)}")
+        for field, allowed in self.choices.items():
+            if field in record and not _is_choice(record[field], allowed):
+                problems.append(f"{field} must be one of {sorted(allowed)}, not {record[field]!r}")
+        return "; ".join(problems) if problems else None
+
+    def construct(self, kwargs, database, intern=None):
+        """
+        Construct a payment from kwargs that have passed check.
+
+        :param kwargs: A dict of kwargs, which is not modified.
+        :param database: A reference to the system database, for the payment to use.
+        :param intern: A function to intern the values of symbols.INTERNED_FIELDS with, or None.
+        :return: The new payment.
+        """
+        if not self.plain:
+            kwargs = {**kwargs, "database": database}
+            if intern is not None:
+                for field in self._interned:
+                    kwargs[field] = intern(kwargs[field])
+            return self.payment_class(**kwargs)
+
+        new_payment = object.__new__(self._layout)
+        new_payment.database = database
+        if intern is None:
+            for field in self.fields:
+                setattr(new_payment, field, kwargs[field])
+        else:
+            for field in self._not_interned:
+                setattr(new_payment, field, kwargs[field])
+            for field in self._interned:
+                setattr(new_payment, field, intern(kwargs[field]))
+        new_payment.payment_id = database.get_next_id()
+        return new_payment
+
+    def to_kwargs(self, record):
+        """
+        :param record: A dict, or a tuple holding the values of fields in order.
+        :return: A dict of kwargs.
+        """
+        if isinstance(record, dict):
+            return record
+        if len(record) != len(self.fields):
+            raise ValueError(
+                f"Invalid record: {self.payment_class.__name__} expects {len(self.fields)} values {self.fields}, "
+                f"got {len(record)}."
+            )
+        return dict(zip(self.fields, record))
+
+def _is_choice(value, allowed):
+    try:
+        return value in allowed
+    except TypeError:
+        # Unhashable, so certainly not one of the choices.
+        return False
+
+class PaymentFactory:
+    """
+    Constructs payments from records, after checking them against the spec of their payment class.  Every method
+    raises a ValueError describing the problem if given an invalid record.
+    """
+    def __init__(self, database, strict=False, symbol_table=symbols.symbols):
+        """
+        :param database: A reference to the system database, given to every payment constructed.
+        :param strict: If true, reject dict records holding fields that are not part of the spec of their class.
+        Otherwise extra fields, such as the columns for other payment types in a CSV file, are ignored.
+        :param symbol_table: The SymbolTable (see symbols.py) to intern the repetitive string fields of every payment
+        with.  Defaults to the shared table.  None disables interning.
+        """
+        self.database = database
+        self.strict = strict
+        self.symbol_table = symbol_table
+
+    def build(self, payment_type, record):
+        """
+        Construct a single payment.
+
+        :param payment_type: The registered name of the payment class, e.g. 'Book'.
+        :param record: A dict, or a tuple holding the values of the spec's fields in order.
+        :return: The new payment.
+        """
+        spec = get_spec(payment_type)
+        return self._construct(spec, self._checked(spec, record))
+
+    def build_record(self, record, type_field="type"):
+        """
+        Construct a single payment from a dict record that names its own payment type.
+
+        :param record: A dict holding the registered name of the payment class under type_field, and its kwargs.
+        :param type_field: The key holding the name of the payment class.
+        :return: The new payment.
+        """
+        return self.build(record.get(type_field), record)
+
+    def build_many(self, payment_type, records):
+        """
+        Construct a batch of payments of the same type.  Every record is checked before any payment is constructed.
+
+        :param payment_type: The registered name of the payment class, e.g. 'Book'.
+        :param records: An iterable of dicts, or tuples holding the values of the spec's fields in order.
+        :return: A list of the new payments, in the order of records.
+        """
+        spec = get_spec(payment_type)
+        checked = [self._checked(spec, record) for record in records]
+        construct = self._construct
+        return [construct(spec, kwargs) for kwargs in checked]
+
+    def _checked(self, spec, record):
+        kwargs = spec.to_kwargs(record)
+        problem = spec.check(kwargs, self.strict)
+        if problem is not None:
+            raise ValueError(f"Invalid record for {spec.payment_class.__name__}: {problem}.")
+        return kwargs
+
+    def _construct(self, spec, kwargs):
+        intern = None if self.symbol_table is None else self.symbol_table.intern
+        return spec.construct(kwargs, self.database, intern)
+
+_specs = {}
+
+def register_payment_type(cls, name=None, choices=None):
+    """
+    Register a payment class with the factory, compiling its spec.
+
+    :param cls: The payment class (must conform to the style guide in payment.py).
+    :param name: The name records will use for the class.  Defaults to the name of the class.
+    :param choices: A dict mapping fields to the values they are allowed to take, as checked by the constructor.
+    Choices checked by the constructors in PLAIN_CONSTRUCTORS are always included.
+    :return: cls, so that this may also be used as a class decorator.
+    """
+    _specs[cls.__name__ if name is None else name] = PaymentSpec(cls, choices)
+    return cls
+
+def get_spec(payment_type):
+    """
+    :param payment_type: The registered name of a payment class.
+    :return: The PaymentSpec of the class.
+    """
+    try:
+        return _specs[payment_type]
+    except KeyError:
+        raise ValueError(f"Invalid record: unknown payment type {payment_type!r}.") from None
+
+def registered_types():
+    """
+    :return: A dict mapping each registered name to its payment class.
+    """
+    return {name: spec.payment_class for name, spec in _specs.items()}
+
+for _cls in (payment.PhysicalProduct, payment.Book, payment.Video, payment.Membership):
+    register_payment_type(_cls)
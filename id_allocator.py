@@ -0,0 +1,114 @@
+"""
+Define the allocator that hands out unique payment IDs.  Every payment asks the database for an ID as it is
+constructed, so this is called from wherever payments are built, potentially from many threads and processes at once.
+A shared counter behind a lock would make every one of those callers wait on each other, so instead the allocator
+leases a contiguous block of IDs at a time from a lease source, separately for each thread, and hands out IDs from
+that block without taking any lock.  Only leasing a new block requires coordination, which the lease source provides.
+
+IDs are unique across every thread and process sharing a lease source.  They are only roughly in order, since each
+thread works through its own block.  IDs in a leased block that are never handed out, e.g. because the process
+exits, are simply skipped.  Use a lease source that persists, such as FileLeaseSource, to keep IDs unique and
+increasing across restarts.
+"""
+
+import os
+import threading
+import weakref
+
+# Every live allocator, so that a single fork hook can reach them all.  Weak, so that registering an allocator does not
+# keep it, or the lease source and database behind it, alive.
+_allocators = weakref.WeakSet()
+
+def _forget_all_blocks():
+    # A forked child starts with a copy of its parent's blocks, so must forget them to avoid handing out the same IDs
+    # as its parent.
+    for allocator in list(_allocators):
+        allocator._forget_blocks()
+
+os.register_at_fork(after_in_child=_forget_all_blocks)
+
+class BlockIdAllocator:
+    """
+    Hands out unique IDs from blocks leased separately for each thread.
+    """
+    def __init__(self, source, block_size=1000):
+        """
+        :param source: The lease source that blocks of IDs are leased from.
+        :param block_size: The number of IDs to lease at a time.
+        """
+        self.source = source
+        self.block_size = block_size
+        self._local = threading.local()
+        _allocators.add(self)
+
+    def _forget_blocks(self):
+        self._local = threading.local()
+
+    def next_id(self):
+        """
+        :return: A new unique ID.
+        """
+        try:
+            return next(self._local.block)
+        except (AttributeError, StopIteration):
+            pass
+        start = self.source.lease(self.block_size)
+        block = self._local.block = iter(range(start, start + self.block_size))
+        return next(block)
+
+class MemoryLeaseSource:
+    """
+    Lease source that keeps its count in memory.  Blocks are only unique within a single process, and counting starts
+    over on every restart.
+    """
+    def __init__(self, start=0):
+        """
+        :param start: The first ID to lease.
+        """
+        self._next = start
+        self._lock = threading.Lock()
+
+    def lease(self, count):
+        """
+        Lease a block of IDs.
+
+        :param count: The number of IDs in the block.
+        :return: The first ID of the block.  The block runs up to but not including the first ID plus count.
+        """
+        with self._lock:
+            start = self._next
+            self._next += count
+            return start
+
+class FileLeaseSource:
+    """
+    Lease source that keeps its count in a file, locked while leasing, so that blocks are unique across every process
+    on the machine using the same file, and across restarts.  Only available on systems that support fcntl.
+    """
+    def __init__(self, path, start=0):
+        """
+        :param path: The path of the file holding the count.  It is created if it does not exist.
+        :param start: The first ID to lease if the file does not exist yet.
+        """
+        self.path = path
+        self.start = start
+
+    def lease(self, count):
+        """
+        Lease a block of IDs.
+
+        :param count: The number of IDs in the block.
+        :return: The first ID of the block.  The block runs up to but not including the first ID plus count.
+        """
+        import fcntl  # Not available on every platform, so only required when this lease source is used.
+
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT), "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            text = f.read().strip()
+            start = int(text) if text else self.start
+            f.seek(0)
+            f.truncate()
+            f.write(str(start + count))
+            f.flush()
+            os.fsync(f.fileno())
+        return start
@@ -0,0 +1,230 @@
+"""
+Define an idempotency index, which lets the processor recognize an order it has already processed even when it is
+resubmitted under a new payment ID, and skip it rather than ship it and pay commission on it a second time.
+
+Every payment is reduced to a key by a configurable key function.  The default, content_key, is the name of the
+payment class and every field except the payment_id, so two payments are duplicates if they are for the same thing, at
+the same value, to the same place.  Use key_on to build a key function from a chosen set of fields instead, e.g. an
+order number supplied upstream.
+
+Keys are hashed to 16 byte digests and kept in an exact store, either in memory or in an SQLite file for more keys than
+fit in memory.  In front of the store sits a Bloom filter, a compact bit array that can say for certain that a key has
+never been seen, so that the store is only consulted for the rare payment that might be a duplicate.  At one percent
+false positives the filter costs about 1.2 bytes per key, so a filter sized for hundreds of millions of keys still
+fits comfortably in memory.  Past its capacity the filter lets more lookups through to the store, which slows the
+index down but never makes it wrong.
+"""
+
+import hashlib
+import math
+import sqlite3
+import threading
+
+from payment import declared_class, payment_fields
+
+def content_key(payment):
+    """
+    The default key function.  Two payments have the same content key when they are of the same class and every one
+    of their fields other than payment_id is equal.
+
+    :param payment: The payment to find the key of.
+    :return: A tuple of the class name and field values.
+    """
+    cls = declared_class(type(payment))
+    return (cls.__name__,) + tuple(getattr(payment, field) for field in payment_fields(cls) if field != "payment_id")
+
+def key_on(*fields):
+    """
+    Build a key function that keys payments on the given fields only, along with the name of their class.  A payment
+    lacking one of the fields contributes None for it.
+
+    :param fields: The names of the payment attributes to key on.
+    :return: A key function for IdempotencyIndex.
+    """
+    def key(payment):
+        return (declared_class(type(payment)).__name__,) + tuple(getattr(payment, field, None) for field in fields)
+    return key
+
+def digest(key):
+    """
+    :param key: A key, as returned by a key function.
+    :return: The 16 byte digest identifying the key.
+    """
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+class BloomFilter:
+    """
+    A Bloom filter over 16 byte digests.  Bit positions are derived from the digest itself, so no further hashing is
+    needed.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        :param capacity: The number of keys the filter is sized for.
+        :param error_rate: The fraction of never seen keys that the filter will report as possibly seen, once it holds
+        capacity keys.
+        """
+        if capacity < 1 or not 0.0 < error_rate < 1.0:
+            raise ValueError("Invalid argument: capacity must be positive and error_rate must be between 0 and 1.")
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key_digest):
+        first = int.from_bytes(key_digest[:8], "little")
+        step = int.from_bytes(key_digest[8:16], "little") | 1
+        size = self.size
+        return [(first + i * step) % size for i in range(self.hash_count)]
+
+    def add(self, key_digest):
+        bits = self.bits
+        for position in self._positions(key_digest):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key_digest):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key_digest))
+
+class MemoryKeyStore:
+    """
+    Exact store of digests that keeps them in memory, so does not persist across restarts.
+    """
+    def __init__(self):
+        self._keys = set()
+
+    def __contains__(self, key_digest):
+        return key_digest in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key_digest):
+        self._keys.add(key_digest)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteKeyStore:
+    """
+    Exact store of digests that keeps them in an SQLite file, so there may be more of them than fit in memory, and
+    they persist across restarts.  New digests are written in batches, each inside a single transaction, like the
+    archives of SQLiteDatabase.  Call commit to write out anything still pending, and close when finished.
+    """
+    def __init__(self, path, batch_size=1000):
+        """
+        :param path: The path of the SQLite file to use.  It may be the same file as an SQLiteDatabase.
+        :param batch_size: The number of new digests to hold before writing them out in one transaction.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        self._pending = set()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency_keys (digest BLOB PRIMARY KEY) WITHOUT ROWID"
+            )
+
+    def __contains__(self, key_digest):
+        with self._lock:
+            if key_digest in self._pending:
+                return True
+            row = self.connection.execute("SELECT 1 FROM idempotency_keys WHERE digest = ?", (key_digest,)).fetchone()
+            return row is not None
+
+    def __iter__(self):
+        self.commit()
+        # Read a page of digests at a time in key order, so that only one page is ever held in memory, however many
+        # digests there are, and the lock is not held between pages.
+        last = b""
+        while True:
+            with self._lock:
+                page = [row[0] for row in self.connection.execute(
+                    "SELECT digest FROM idempotency_keys WHERE digest > ? ORDER BY digest LIMIT 10000", (last,)
+                )]
+            if not page:
+                return
+            yield from page
+            last = page[-1]
+
+    def __len__(self):
+        self.commit()
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0]
+
+    def add(self, key_digest):
+        with self._lock:
+            self._pending.add(key_digest)
+            if len(self._pending) >= self.batch_size:
+                self.commit()
+
+    def commit(self):
+        """
+        Write out every pending digest.
+        """
+        with self._lock:
+            if self._pending:
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO idempotency_keys VALUES (?)", ((d,) for d in self._pending)
+                    )
+                self._pending.clear()
+
+    def close(self):
+        """
+        Commit and close the connection.  The store may not be used afterwards.
+        """
+        with self._lock:
+            self.commit()
+            self.connection.close()
+
+class IdempotencyIndex:
+    """
+    Remembers the key of every payment processed successfully.  Give it to a processor with the idempotency argument
+    of Processor, and the processor will skip any payment whose key is already in the index.  Failed payments are not
+    remembered, so they may be resubmitted.
+    """
+    def __init__(self, key=content_key, store=None, capacity=10_000_000, error_rate=0.01):
+        """
+        :param key: The key function, taking a payment and returning a tuple of values identifying its order.
+        :param store: The exact store of digests, a MemoryKeyStore or SQLiteKeyStore.  Defaults to a new
+        MemoryKeyStore.  Any digests already in the store are loaded into the Bloom filter.
+        :param capacity: The number of keys the Bloom filter is sized for.
+        :param error_rate: The false positive rate of the Bloom filter at capacity.
+        """
+        self.key = key
+        self.store = MemoryKeyStore() if store is None else store
+        self.bloom = BloomFilter(capacity, error_rate)
+        for key_digest in self.store:
+            self.bloom.add(key_digest)
+
+    def check(self, payment):
+        """
+        :param payment: The payment to look up.
+        :return: The digest of the payment's key, or None if the payment is a duplicate of one already in the index.
+        """
+        key_digest = digest(self.key(payment))
+        if key_digest in self.bloom and key_digest in self.store:
+            return None
+        return key_digest
+
+    def add(self, key_digest):
+        """
+        Remember a digest returned by check, once its payment has been processed successfully.
+        """
+        self.bloom.add(key_digest)
+        self.store.add(key_digest)
+
+    def commit(self):
+        """
+        Write out anything the store is holding back.
+        """
+        self.store.commit()
+
+    def close(self):
+        self.store.close()
@@ -0,0 +1,222 @@
+"""
+Stream payments from a file into the processor.  Where run_payments.py builds a fixed list of payments by hand, this
+reads payment records lazily from a JSON lines or CSV file, constructs each payment only as the processor asks for the
+next one, and writes failures out as they happen.  Nothing is ever collected into a list.  The archives of the database
+do keep every payment processed, so for files larger than memory, give the processor a database whose archives are on
+disk: an SQLiteDatabase, or a Database with windowed archives (see make_database).
+
+Each record names the class of payment to construct in its 'type' field, e.g. 'Book' or 'Membership', and supplies
+the kwargs that class requires as its other fields.  Payments are constructed by the payment factory (see factory.py),
+so any payment type registered there may be used, and records are checked before a payment is constructed.  For
+example, as JSON:
+
+    {"type": "Book", "value": 150.00, "product_id": "Jackson EM Textbook", "shipping_address": "erics house",
+     "agent": "anne"}
+
+CSV files should have a header row.  Since CSV cannot tell text from numbers or missing values, value is always read
+as a number, and empty cells are read as None.
+
+This file may also be run as a script, see main for usage.
+"""
+
+import argparse
+import csv
+import json
+import os
+import tempfile
+
+import checkpoint
+from archive import OrderArchive
+from database import Database
+from factory import PaymentFactory
+from payment import payment_fields
+from processor import Processor, require_sync
+from sink import FileSink
+from sqlite_database import ARCHIVES, SQLiteDatabase
+
+def read_jsonl(path):
+    """
+    Lazily read records from a JSON lines file.
+
+    :param path: The path of the file to read.
+    :return: A generator yielding one dict per non-blank line.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_csv(path):
+    """
+    Lazily read records from a CSV file with a header row.
+
+    :param path: The path of the file to read.
+    :return: A generator yielding one dict per row.
+    """
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            record = {key: (None if cell == "" else cell) for key, cell in row.items()}
+            if record.get("value") is not None:
+                record["value"] = float(record["value"])
+            yield record
+
+def read_records(path):
+    """
+    Lazily read records from a file, choosing the reader by the extension of the file.  Files ending in .csv are
+    read as CSV, and all others as JSON lines.
+    """
+    if path.lower().endswith(".csv"):
+        return read_csv(path)
+    else:
+        return read_jsonl(path)
+
+def build_payments(records, database, on_reject=None):
+    """
+    Lazily construct payments from records.
+
+    :param records: An iterable of dicts, each holding a 'type' field and the kwargs for that type of payment.  Any
+    other fields, such as the payment_id and error written out by a FailureWriter, are ignored.
+    :param database: A reference to the system database, given to every payment.
+    :param on_reject: A function called with (record, error message) for each record that cannot be made into a
+    payment.  If not given, the exception is raised instead.
+    :return: A generator yielding each payment.
+    """
+    factory = PaymentFactory(database)
+    for record in records:
+        try:
+            new_payment = factory.build_record(record)
+        except ValueError as e:
+            if on_reject is None:
+                raise
+            on_reject(record, str(e))
+            continue
+        yield new_payment
+
+class FailureWriter:
+    """
+    Writes payments that failed processing, and records that could not be made into payments, to a JSON lines file
+    as they happen.  The output can be read back in by read_jsonl to retry the failures.
+    """
+    def __init__(self, path):
+        """
+        :param path: The path of the file to write failures to.  The file is overwritten.
+        """
+        self.file = open(path, "w")
+        self.failed = 0
+        self.rejected = 0
+
+    def write_failed(self, failed_payment):
+        """
+        Write out a payment that failed processing.
+        """
+        cls = type(failed_payment)
+        record = {"type": cls.__name__}
+        for field in payment_fields(cls):
+            record[field] = getattr(failed_payment, field)
+        self.file.write(json.dumps(record) + "\n")
+        self.failed += 1
+
+    def write_rejected(self, record, error):
+        """
+        Write out a record that could not be made into a payment, along with the reason why.
+        """
+        self.file.write(json.dumps({**record, "error": error}) + "\n")
+        self.rejected += 1
+
+    def close(self):
+        self.file.close()
+
+def make_database(database_path=None, window=None, spill_dir=None):
+    """
+    Make a database whose archives do not grow in memory with the number of payments processed.
+
+    :param database_path: If given, the path of an SQLite file to keep everything in, see sqlite_database.py.
+    :param window: Otherwise, if given, the number of records each archive of a Database keeps in memory.  Older
+    records are spilled to files in spill_dir.
+    :param spill_dir: The directory to spill records to.  Required if window is given.
+    :return: An SQLiteDatabase, or a Database, with windowed archives if window is given.  Close it with
+    close_database when finished.
+    """
+    if database_path is not None:
+        return SQLiteDatabase(database_path)
+    database = Database()
+    if window is not None:
+        if spill_dir is None:
+            raise ValueError("Invalid argument: spill_dir is required when window is given.")
+        # Replaces the archives on this instance only, leaving those shared through the class untouched.
+        for name in ARCHIVES:
+            setattr(database, name, OrderArchive(window, os.path.join(spill_dir, f"{name}.spill")))
+    return database
+
+def close_database(database):
+    """
+    Write out and close a database made by make_database.
+    """
+    if isinstance(database, SQLiteDatabase):
+        database.close()
+    else:
+        for name in ARCHIVES:
+            getattr(database, name).close()
+
+def process_file(path, processor, failures_path=None, checkpoint_path=None):
+    """
+    Stream every payment in a file through a processor.
+
+    :param path: The path of a JSON lines or CSV file of payment records.
+    :param processor: The processor to use.  Its database is given to every payment.
+    :param failures_path: If given, failed payments and rejected records are written to this file as JSON lines.
+    Otherwise a record that cannot be made into a payment raises an exception.
+    :param checkpoint_path: If given, progress is logged to this file (see checkpoint.py), and if it already exists, a
+    previous run over the same file is resumed, skipping every payment that completed.
+    :return: A tuple of (number of failed payments, number of rejected records).
+    """
+    require_sync(processor)
+    progress = None if checkpoint_path is None else checkpoint.ProgressLog(checkpoint_path)
+    writer = None if failures_path is None else FailureWriter(failures_path)
+    try:
+        payments = build_payments(read_records(path), processor.database, writer and writer.write_rejected)
+        if progress is None:
+            failures = processor.iter_failures(payments)
+        else:
+            failures = checkpoint.iter_failures(processor, payments, progress)
+
+        if writer is None:
+            return sum(1 for _ in failures), 0
+        for failed_payment in failures:
+            writer.write_failed(failed_payment)
+        return writer.failed, writer.rejected
+    finally:
+        if writer is not None:
+            writer.close()
+        if progress is not None:
+            progress.close()
+
+def main():
+    """
+    Usage: python ingest.py payments.jsonl [--failures failed.jsonl] [--actions actions.jsonl] [--checkpoint log]
+        [--database payments.sqlite | --window 100000]
+    """
+    parser = argparse.ArgumentParser(description="Stream payments from a JSON lines or CSV file through the processor.")
+    parser.add_argument("path", help="The file of payment records to process.")
+    parser.add_argument("--failures", help="Write failed payments and rejected records to this file.")
+    parser.add_argument("--actions", help="Write the action log to this file as JSON lines, instead of printing it.")
+    parser.add_argument("--checkpoint", help="Log progress to this file, resuming from it if it exists.")
+    storage = parser.add_mutually_exclusive_group()
+    storage.add_argument("--database", help="Keep the database, and its archives, in this SQLite file.")
+    storage.add_argument(
+        "--window", type=int, help="Keep only this many records of each archive in memory, spilling the rest to disk."
+    )
+    args = parser.parse_args()
+
+    sink = None if args.actions is None else FileSink(args.actions)
+    with tempfile.TemporaryDirectory() as spill_dir:
+        processor = Processor(make_database(args.database, args.window, spill_dir), sink)
+        try:
+            failed, rejected = process_file(args.path, processor, args.failures, args.checkpoint)
+        finally:
+            processor.sink.close()
+            close_database(processor.database)
+    print(f"Completed processing of {args.path}: {failed} payments failed, {rejected} records rejected.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Define optional instrumentation for the processor, to find out where processing time goes without attaching a
+profiler.  When a processor is given an Instrumentation, it records:
+
+    phases      the time spent in each of process_begin, process_middle and process_end, for each payment class
+    actions     the number of calls to, and time spent in, each processor action called by the payments, such as
+                generate_commission or video_addon
+
+Every timing is kept in a LatencyHistogram, which has a fixed number of buckets, so memory use does not grow with the
+number of payments processed.  Read the results with Instrumentation.snapshot, or write them to a JSON file with
+Instrumentation.dump.
+
+A processor without instrumentation pays nothing for it beyond a single check per payment.  Actions are only timed
+because an Instrumentation replaces them on the processor it is attached to; the methods of the Processor class itself
+are never touched.
+"""
+
+import json
+import time
+
+# The processor actions that payments call, and which are timed by default.
+ACTIONS = (
+    "generate_packing_slip",
+    "generate_commission",
+    "generate_royalty_packing_slip",
+    "send_membership_email",
+    "upgrade_membership",
+    "activate_membership",
+    "video_addon",
+)
+
+# Each power of two is split into this many buckets (as a power of two), so a bucket is never wider than a quarter of
+# the values it holds.
+_SUB_BUCKET_BITS = 2
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+
+def _bucket_index(ns):
+    if ns < _SUB_BUCKETS:
+        return max(ns, 0)
+    shift = ns.bit_length() - _SUB_BUCKET_BITS - 1
+    return (shift << _SUB_BUCKET_BITS) + (ns >> shift)
+
+def _bucket_bounds(index):
+    """
+    :return: The lowest and highest number of nanoseconds that fall into a bucket.
+    """
+    if index < _SUB_BUCKETS:
+        return index, index
+    shift = (index >> _SUB_BUCKET_BITS) - 1
+    mantissa = (index & (_SUB_BUCKETS - 1)) + _SUB_BUCKETS
+    return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+class LatencyHistogram:
+    """
+    A histogram of durations, in nanoseconds, with logarithmically sized buckets.  Percentiles read from it are
+    accurate to within the width of a bucket, about 25%.  Updates are not locked, so when several threads share a
+    histogram an occasional count may be lost.
+    """
+    def __init__(self):
+        self.buckets = [0] * (64 << _SUB_BUCKET_BITS)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self, ns):
+        """
+        Record a single duration.
+
+        :param ns: The duration in nanoseconds.
+        """
+        self.buckets[_bucket_index(ns)] += 1
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    def percentile(self, fraction):
+        """
+        :param fraction: The percentile to read, as a fraction between 0 and 1, e.g. 0.99.
+        :return: The estimated duration at that percentile in nanoseconds, or None if nothing has been recorded.
+        """
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                low, high = _bucket_bounds(index)
+                return min((low + high) / 2, self.max_ns)
+        return self.max_ns
+
+    def snapshot(self):
+        """
+        :return: A dict summarizing the histogram, with durations in microseconds.  buckets maps the lower bound of
+        every non-empty bucket, in nanoseconds, to its count.
+        """
+        def us(ns):
+            return None if ns is None else ns / 1000
+
+        return {
+            "count": self.count,
+            "total_us": us(self.total_ns),
+            "mean_us": us(self.total_ns / self.count) if self.count else None,
+            "p50_us": us(self.percentile(0.50)),
+            "p90_us": us(self.percentile(0.90)),
+            "p99_us": us(self.percentile(0.99)),
+            "max_us": us(self.max_ns),
+            "buckets": {_bucket_bounds(i)[0]: count for i, count in enumerate(self.buckets) if count},
+        }
+
+class Instrumentation:
+    """
+    Collects phase and action timings from the processors it is attached to.  Give it to a processor with the
+    instrumentation argument of Processor.  A single Instrumentation may be shared by several processors, in which
+    case their timings are combined.
+
+    Payments processed in parallel mode run their steps in worker processes, which are not timed.
+    """
+    def __init__(self, actions=ACTIONS):
+        """
+        :param actions: The names of the processor methods to time.
+        """
+        self.action_names = tuple(actions)
+        self.reset()
+
+    def reset(self):
+        """
+        Discard everything recorded so far.
+        """
+        self.phases = {}
+        self.actions = {name: LatencyHistogram() for name in self.action_names}
+
+    def attach(self, processor):
+        """
+        Time the actions of a processor, by shadowing each of its action methods with a timed wrapper.  Called by
+        Processor, which then also passes every payment it processes to run_plan.  Actions named in the
+        deferred_actions of the processor, if it has any, are left for the processor to time itself when they are
+        actually carried out, as AsyncProcessor does.
+        """
+        deferred = getattr(processor, "deferred_actions", ())
+        for name in self.action_names:
+            if name not in deferred:
+                setattr(processor, name, _timed(getattr(processor, name), self.actions[name]))
+
+    def detach(self, processor):
+        """
+        Undo attach, restoring the original action methods of a processor.
+        """
+        for name in self.action_names:
+            processor.__dict__.pop(name, None)
+
+    def phase_histograms(self, plan):
+        """
+        :return: A dict mapping each phase of an action plan to the LatencyHistogram of its payment class.
+        """
+        try:
+            return self.phases[plan.payment_class.__name__]
+        except KeyError:
+            histograms = self.phases[plan.payment_class.__name__] = {phase: LatencyHistogram() for phase in plan.phases}
+            return histograms
+
+    def run_plan(self, plan, payment, processor):
+        """
+        Run an action plan, timing each phase.  The timed equivalent of ActionPlan.run.
+        """
+        histograms = self.phase_histograms(plan)
+        clock = time.perf_counter_ns
+        for phase, actions in plan.phases.items():
+            start = clock()
+            try:
+                for action in actions:
+                    action(payment, processor)
+            finally:
+                histograms[phase].record(clock() - start)
+
+    def snapshot(self):
+        """
+        :return: A dict of everything recorded so far, safe to serialize as JSON.  Its phases entry maps each payment
+        class name to a dict mapping each phase to a histogram summary, and its actions entry maps each action name to
+        a histogram summary.  See LatencyHistogram.snapshot.
+        """
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "phases": {
+                name: {phase: histogram.snapshot() for phase, histogram in histograms.items()}
+                for name, histograms in self.phases.items()
+            },
+            "actions": {name: histogram.snapshot() for name, histogram in self.actions.items()},
+        }
+
+    def dump(self, path):
+        """
+        Write a snapshot to a JSON file.
+
+        :param path: The path of the file to write.  The file is overwritten.
+        """
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+def _timed(method, histogram):
+    clock = time.perf_counter_ns
+    record = histogram.record
+
+    def timed(*args, **kwargs):
+        start = clock()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            record(clock() - start)
+
+    return timed
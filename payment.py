@@ -27,6 +27,8 @@ classes' requirements, but should not typically be used in the production system
 3. In a test environment, call the function "helper_check_declared_attributes" to get a list of all attributes
 declared by all parent classes of your new class.  This function, similar to above, is provided as a helper to avoid
 overloading or overwriting any parent classes attributes.  NO PAYMENT SHOULD EVER OVERWRITE ANY PARENT CLASS ATTRIBUTE.
+Defining a class that declares the same attribute as one of its parents raises a TypeError immediately, but the helper
+is still useful for seeing which attributes are already taken.
 4. The constructor of your subclass must follow these steps/requirements in order:
     4.a The constructor for your subclass MUST FOLLOW the __init__(self, **kwargs) PATTERN.  Positional arguments are
     not allowed for any Payment subclass.
@@ -35,13 +37,16 @@ overloading or overwriting any parent classes attributes.  NO PAYMENT SHOULD EVE
     for the base class.
     4.c You MUST use super().__init__(**kwargs)
     4.d You may then instantiate any attributes for your derived class.  These MAY NOT override any attributes of any
-    parent class.
+    parent class.  Payments have no __dict__, so assigning an attribute that is not declared in the attributes set of
+    your class or a parent (see 5.a) raises an AttributeError.
     4.e You should avoid doing anything else in the constructor, and may not call any processing operations here.
 5. Define three class attributes for your derived class: attributes, required_kwargs, and filled_kwargs.  These are each
 sets of strings and are required for the helper functions to work.  These sets MUST ALWAYS BE DEFINED, even if they
-are empty.  These attributes have no function within the production system, but are used solely during development by
-the helper functions.
-    5.a attributes should hold the name of each attribute defined by your derived class.
+are empty.  required_kwargs and filled_kwargs have no function within the production system, but are used solely
+during development by the helper functions.
+    5.a attributes should hold the name of each attribute defined by your derived class.  The Payment metaclass turns
+    these declarations into the __slots__ of each payment, so this set must be complete.  Do not define __slots__
+    yourself.
     5.b required_kwargs should hold the name of each kwarg that your derived class will expect to be fed to its
     constructor.  This should contain only kwargs defined in the derived_class - kwargs required by parent classes will
     be declared by those classes.
@@ -52,6 +57,11 @@ the helper functions.
     help determine which kwargs need to be supplied to their constructor, alongside required_kwargs,
     and this particular attribute merely exists to subtract away required kwargs for parents to the derived class
     that the derived class will handle.
+    5.d Because the attributes become slots on a hidden layout class (see PaymentMeta), a payment is an instance of
+    the layout class of its class, not of the class itself.  THIS BREAKS EXACT TYPE CHECKS: type(payment) is Book is
+    False for a Book, and so is type(payment) == Book.  isinstance(payment, Book) and the name of the type still work
+    as before.  Where the exact class matters, as when dispatching on it or using it as a key, compare
+    declared_class(type(payment)) instead, which gives the class as defined in code.
 6. Define all necessary process functions: process_begin, process_middle, and process_end.  These functions may
 take only a single argument, processor, a reference to the payment system processor.  Most processing steps should
 be done in process_middle, particularly those that are not order-dependent with other steps.  process_begin and
@@ -62,12 +72,17 @@ process step across the inheritance hierarchy more complicated than this, and th
 based on the hierarchy MRO, you may need to abandon sub-classing and re-implement the logic of the payment subclass
 from a more primitive starting point.  You do not need to implement all three of process_begin, process_middle,
 and process_end, though at least one should be implemented to have any purpose to the payment subclass.
-    6.a When overriding process_begin or process_middle, the first line of the function implementation must call the
-    parent's method: super().process_begin(processor) or super().process_middle(processor).  I.E. parent classes will
-    trigger their process operations before those of the derived class.
-    6.b When overriding process_end, the last line of the function implementation must call the parent's method:
-    super().process_end(processor).  I.E. parent classes will trigger their process end operations after those of the
+    6.a Process functions should only contain the steps belonging to your derived class, and MUST NOT call the
+    parent's method via super().  The processor compiles the process functions of every class in the MRO into a single
+    flat plan once per class (see plan.py), and will itself call the parent classes' steps in the correct order.
+    Compiling the plan of a class whose process function uses super() raises a TypeError, rather than running the
+    parent's steps twice.  For the same reason, calling a process function directly runs only that class's own step;
+    run the compiled plan to process a payment.
+    6.b For process_begin and process_middle, parent classes will trigger their process operations before those of the
     derived class.
+    6.c For process_end, parent classes will trigger their process end operations after those of the derived class.
+    6.d In a test environment, you may print the result of plan.compile_plan on your new class to see every step it
+    will fire, in order.
 
 class ExamplePayment(Payment):
     attributes = set()
@@ -85,48 +100,129 @@ class ExamplePayment(Payment):
         # Instantiate local attributes
 
     def process_begin(self, processor):
-        super().process_begin(processor)
-
         # Code goes here
 
     def process_middle(self, processor):
-        super().process_middle(processor)
-
         # Code goes here
 
     def process_end(self, processor):
         # Code goes here
 
-        super().process_end(processor)
-
 """
 
-class Payment:
+import functools
+
+# Names that appear in the attributes sets, but are class level declarations rather than per-payment data.
+CLASS_ATTRIBUTES = {"attributes", "required_kwargs", "filled_kwargs"}
+
+class PaymentMeta(type):
+    """
+    Metaclass for Payment, which turns the attributes sets declared by each payment class into real __slots__, and
+    checks those declarations when each class is defined.
+
+    Python does not allow a class to inherit from more than one base that has __slots__ of its own, which would rule
+    out the multiple inheritance that the style guide allows.  So the classes defined in code are all given empty
+    __slots__, and the slots themselves live on a layout class: a hidden subclass, created the first time a payment
+    class is instantiated, that holds a slot for every attribute declared anywhere in the MRO.  Constructing a payment
+    class actually returns an instance of its layout class, which behaves exactly like the class it was made for, and
+    has the same name.  Use declared_class to get the class as defined in code from the type of a payment.
+    """
+    def __new__(mcs, name, bases, namespace):
+        if "_layout_of" not in namespace:
+            if "__slots__" in namespace:
+                raise TypeError(f"Payment class {name} may not define __slots__, declare its attributes instead.")
+            namespace["__slots__"] = ()
+        cls = super().__new__(mcs, name, bases, namespace)
+        if "_layout_of" not in namespace:
+            mcs._check_declared_attributes(cls)
+        return cls
+
+    @staticmethod
+    def _check_declared_attributes(cls):
+        """
+        Raise a TypeError if cls declares an attribute already declared by one of its parents, or one that would be
+        hidden by a class level name such as a method.
+        """
+        owners = {}
+        for c in cls.mro()[:-1]:
+            for attr in c.__dict__.get("attributes", ()):
+                if attr in owners and attr not in CLASS_ATTRIBUTES:
+                    raise TypeError(
+                        f"Payment class {cls.__name__} is invalid: attribute {attr} is declared by both "
+                        f"{c.__name__} and {owners[attr].__name__}."
+                    )
+                owners.setdefault(attr, c)
+        for attr, owner in owners.items():
+            if attr not in CLASS_ATTRIBUTES:
+                for c in cls.mro()[:-1]:
+                    if attr in c.__dict__:
+                        raise TypeError(
+                            f"Payment class {cls.__name__} is invalid: attribute {attr} declared by {owner.__name__} "
+                            f"conflicts with a class level name in {c.__name__}."
+                        )
+
+    def layout(cls):
+        """
+        Get the layout class for a payment class, creating it the first time it is needed.
+        """
+        if "_layout_of" in cls.__dict__:
+            return cls
+        try:
+            return cls.__dict__["_layout_class"]
+        except KeyError:
+            pass
+        layout = type(cls)(cls.__name__, (cls,), {
+            "__slots__": ("database",) + payment_fields(cls),
+            "__module__": cls.__module__,
+            "__qualname__": cls.__qualname__,
+            "_layout_of": cls,
+        })
+        type.__setattr__(cls, "_layout_class", layout)
+        return layout
+
+class Payment(metaclass=PaymentMeta):
     attributes = {"database", "attributes", "required_kwargs", "filled_kwargs", "value", "payment_id"}
     required_kwargs = {"database", "value"}
     filled_kwargs = set()
 
+    def __new__(cls, **kwargs):
+        return object.__new__(cls.layout())
+
     def __init__(self, **kwargs):
         self.database = kwargs["database"]
         self.value = kwargs["value"]
         self.payment_id = self.database.get_next_id()
 
-    def process_begin(self, processor):
-        pass
+    def __reduce__(self):
+        # The layout class cannot be found by name, so pickle payments as the class they were declared as.
+        state = {slot: getattr(self, slot) for slot in type(self).__slots__ if hasattr(self, slot)}
+        return _restore_payment, (declared_class(type(self)), state)
 
-    def process_middle(self, processor):
-        pass
+def _restore_payment(cls, state):
+    """
+    Re-create a pickled payment.
+    """
+    payment = cls.__new__(cls)
+    for attr, value in state.items():
+        setattr(payment, attr, value)
+    return payment
 
-    def process_end(self, processor):
-        pass
+def declared_class(cls):
+    """
+    Get the payment class as defined in code, given the type of a payment, which may be its layout class.  See
+    PaymentMeta, and 5.d of the style guide for why exact type checks need this.
+    """
+    return cls.__dict__.get("_layout_of", cls)
 
-def helper_check_required_kwargs(cls):
+def collect_kwargs(cls):
     """
-    Helper function that prints out all kwargs that will be required for the constructor of the class you give it to
-    check.  This function also checks for conflicts where a single kwarg is used by more than one parent class,
-    which may lead to unexpected behavior and should be avoided.
+    Collect the kwargs required and filled by every class in the MRO of a class.  This is the logic behind
+    helper_check_required_kwargs, and is also used by the payment factory (see factory.py) in production.
 
     :param cls: The class (must be a subclass of Payment, conforming to the style guide) you want to check.
+    :return: A tuple of (all_kwargs, removed_kwargs).  all_kwargs maps each kwarg required by any class in the MRO to
+    the set of names of the classes that require it.  removed_kwargs is the set of kwargs filled by any class in the
+    MRO, which therefore do not need to be passed to the constructor.
     """
     all_kwargs = {}
     removed_kwargs = set()
@@ -143,6 +239,18 @@ def helper_check_required_kwargs(cls):
         # removed kwargs is a set of all kwargs that get filled by any class in the hierarchy and so are unneeded.
         removed_kwargs |= c.filled_kwargs
 
+    return all_kwargs, removed_kwargs
+
+def helper_check_required_kwargs(cls):
+    """
+    Helper function that prints out all kwargs that will be required for the constructor of the class you give it to
+    check.  This function also checks for conflicts where a single kwarg is used by more than one parent class,
+    which may lead to unexpected behavior and should be avoided.
+
+    :param cls: The class (must be a subclass of Payment, conforming to the style guide) you want to check.
+    """
+    all_kwargs, removed_kwargs = collect_kwargs(cls)
+
     print(f"Checking required kwargs for class {cls}...")
     for kwarg, classes in all_kwargs.items():
         if len(classes) == 1:
@@ -182,6 +290,40 @@ def helper_check_declared_attributes(cls):
     print(" - Check complete.")
     print("------------------\n")
 
+@functools.lru_cache(maxsize=None)
+def payment_fields(cls):
+    """
+    Get the names of every attribute holding data for a payment of the given class, as declared by the attributes
+    sets of the class and its parents.  Class level declarations and the reference to the database are left out,
+    so these are the fields needed to export, archive, or re-create a payment.  Unlike the helper functions above,
+    this is intended for use in the production system, and the result is cached per class.
+
+    :param cls: The class (must be a subclass of Payment, conforming to the style guide) you want the fields of.
+    :return: A tuple of attribute names, ordered with parent classes first and alphabetically within each class.
+    """
+    fields = []
+    for c in reversed(cls.mro()[:-1]):
+        for attr in sorted(c.__dict__.get("attributes", ())):
+            if attr not in CLASS_ATTRIBUTES and attr != "database" and attr not in fields:
+                fields.append(attr)
+    return tuple(fields)
+
+def find_payment_class(name):
+    """
+    Find a payment class by its name, searching every subclass of Payment defined so far.
+
+    :param name: The __name__ of the class to find.
+    :return: The payment class.
+    :raises KeyError: if no subclass of Payment has that name.
+    """
+    unchecked = [Payment]
+    while unchecked:
+        cls = unchecked.pop()
+        if cls.__name__ == name and "_layout_of" not in cls.__dict__:
+            return cls
+        unchecked += cls.__subclasses__()
+    raise KeyError(name)
+
 # ======================================================================================================================
 # Payment subclass implementations below this line
 # ======================================================================================================================
@@ -206,15 +348,11 @@ class PhysicalProduct(Payment):
         self.agent = kwargs["agent"]
 
     def process_middle(self, processor):
-        super().process_middle(processor)
-
         processor.generate_commission(self)
 
     def process_end(self, processor):
         processor.generate_packing_slip(self)
 
-        super().process_end(processor)
-
 class Book(PhysicalProduct):
     """
     Required kwargs:
@@ -229,10 +367,11 @@ class Book(PhysicalProduct):
     filled_kwargs = set()
 
     def process_middle(self, processor):
-        super().process_middle(processor)
-
         processor.generate_royalty_packing_slip(self)
 
+# The values membership_payment_type may take.
+MEMBERSHIP_PAYMENT_TYPES = ("upgrade", "activation")
+
 class Membership(Payment):
     attributes = {"membership_payment_type", "membership_id", "member_id"}
     required_kwargs = {"membership_payment_type", "membership_id", "member_id"}
@@ -255,14 +394,12 @@ class Membership(Payment):
         self.membership_id = kwargs["membership_id"]
         self.member_id = kwargs["member_id"]
         ptype = kwargs["membership_payment_type"]
-        if ptype == "upgrade" or ptype == "activation":
+        if ptype in MEMBERSHIP_PAYMENT_TYPES:
             self.membership_payment_type = ptype
         else:
             raise ValueError("Invalid argument: membership_payment_type must be either 'upgrade' or 'activation'.")
 
     def process_middle(self, processor):
-        super().process_middle(processor)
-
         if self.membership_payment_type == "upgrade":
             processor.upgrade_membership(self)
         else:
@@ -271,8 +408,6 @@ class Membership(Payment):
     def process_end(self, processor):
         processor.send_membership_email(self)
 
-        super().process_end(processor)
-
 class Video(PhysicalProduct):
     """
     Required kwargs:
@@ -282,10 +417,14 @@ class Video(PhysicalProduct):
         shipping_address
         agent
     """
-    def process_middle(self, processor):
-        super().process_middle(processor)
+    attributes = set()
+    required_kwargs = set()
+    filled_kwargs = set()
 
-        # Check whether an add-on product is required
-        if self.product_id in self.database.video_addons.keys():
-            processor.video_addon(self.database.video_addons[self.product_id])
+    def process_middle(self, processor):
+        # Check whether an add-on product is required.  The table is read just once, since it may be swapped for a
+        # new version at any time (see tables.py).
+        video_addons = self.database.video_addons
+        if self.product_id in video_addons.keys():
+            processor.video_addon(self, video_addons[self.product_id])
 
@@ -0,0 +1,119 @@
+"""
+Compile payment subclasses into flat action plans.  Every payment subclass spreads its processing steps across the
+classes in its inheritance hierarchy, and the processor needs to run all of them in the correct order.  Rather than
+walking that hierarchy through a chain of super() calls for every single payment, the processor asks this module for
+the plan belonging to the class of the payment.  A plan is resolved from the MRO only once per class and then cached,
+and is nothing more than an ordered tuple of the process functions defined by the class and its parents.
+
+The ordering rules are the ones laid out in the style guide in payment.py:
+
+    process_begin   - parent classes run before derived classes (reverse MRO)
+    process_middle  - parent classes run before derived classes (reverse MRO)
+    process_end     - derived classes run before parent classes (MRO)
+
+Plans can be printed to see exactly which steps a given payment type will fire, and in which order.
+
+Since the plan already runs the steps of every parent class, a process function that still calls its parent's
+through super(), as the style guide once required, would run the parent's steps twice.  Compiling a plan for such a
+class raises a TypeError instead.
+"""
+
+from payment import declared_class
+
+PHASES = ("process_begin", "process_middle", "process_end")
+
+_plans = {}
+
+class ActionPlan:
+    """
+    The compiled, ordered list of process steps for a single payment class.  Each step is stored as a tuple of
+    (phase, owner, function), where owner is the class in the hierarchy that defined the function.  A plan should be
+    treated as immutable once compiled.
+    """
+    def __init__(self, payment_class, steps):
+        """
+        :param payment_class: The payment class this plan was compiled for.
+        :param steps: A tuple of (phase, owner, function) tuples, already in execution order.
+        """
+        self.payment_class = payment_class
+        self.steps = steps
+        self.actions = tuple(function for _, _, function in steps)
+        self.phases = {phase: tuple(function for p, _, function in steps if p == phase) for phase in PHASES}
+
+    def phase(self, phase):
+        """
+        Get the functions that make up a single phase of the plan, in execution order.
+
+        :param phase: One of the strings in PHASES.
+        :return: A tuple of functions that each take (payment, processor).
+        """
+        return self.phases[phase]
+
+    def run(self, payment, processor):
+        """
+        Run every step of the plan on a payment.
+
+        :param payment: The payment to process.  Must be an instance of the class this plan was compiled for.
+        :param processor: The processor the steps will call back into.
+        """
+        for action in self.actions:
+            action(payment, processor)
+
+    def describe(self):
+        """
+        :return: A list of strings naming each step in execution order, e.g. 'process_middle: PhysicalProduct'.
+        """
+        return [f"{phase}: {owner.__name__}" for phase, owner, _ in self.steps]
+
+    def __repr__(self):
+        return f"<ActionPlan for {self.payment_class.__name__}: {len(self.steps)} steps>"
+
+    def __str__(self):
+        lines = [f"Action plan for class {self.payment_class.__name__}:"]
+        lines += [f" | {step}" for step in self.describe()]
+        return "\n".join(lines)
+
+def _check_no_super(owner, phase, function):
+    """
+    Raise a TypeError if a process function calls super(), see 6.a of the style guide in payment.py.
+    """
+    code = getattr(function, "__code__", None)
+    if code is not None and ("super" in code.co_names or "__class__" in code.co_freevars):
+        raise TypeError(
+            f"Payment class {owner.__name__} is invalid: {phase} must not call super(), the action plan already runs "
+            f"the {phase} of every parent class."
+        )
+
+def compile_plan(cls):
+    """
+    Get the action plan for a payment class, compiling and caching it the first time the class is seen.
+
+    :param cls: The payment class (must conform to the style guide in payment.py) to compile, or the type of a
+    payment, which will share the plan of the class it was declared as.
+    :return: The ActionPlan for cls.
+    """
+    try:
+        return _plans[cls]
+    except KeyError:
+        pass
+
+    declared = declared_class(cls)
+    if declared is not cls:
+        plan = _plans[cls] = compile_plan(declared)
+        return plan
+
+    # Only functions defined directly on a class belong to that class's step, so look in __dict__ rather than using
+    # getattr, which would pick up the parent's function a second time.  Ignore object at the end of the MRO.
+    mro = cls.mro()[:-1]
+    steps = []
+    for phase in PHASES:
+        ordered = mro if phase == "process_end" else reversed(mro)
+        for c in ordered:
+            function = c.__dict__.get(phase)
+            if function is not None:
+                _check_no_super(c, phase, function)
+                steps.append((phase, c, function))
+
+    plan = ActionPlan(cls, tuple(steps))
+    _plans[cls] = plan
+    return plan
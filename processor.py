@@ -1,67 +1,83 @@
 """
 Define an object that mimics an ERP system.  The processor will accept a completed payment object and run it,
 during the course of which the payment will call various methods on the processor to actually accomplish work.  Since
-this is just a demo, the processor will only print statements showing what actions it is taking throughout the course
-of processing a payment.
+this is just a demo, the processor will only record what actions it is taking throughout the course of processing a
+payment, to an action sink (see sink.py) that by default prints them.
 
 Implement new functions within the processor as necessary to satisfy processing requirements.  Note in the docstring
 for each process operation which attributes each operation will need to access, to help determine compatibility.
 """
 
-from payment import Payment
+import copy
+import inspect
+import zlib
+from multiprocessing import Pool, resource_tracker
 
-class Processor:
-    def __init__(self, database):
+import binary
+from payment import Payment, declared_class
+from plan import compile_plan
+from sink import MemorySink, PrintSink
+
+class BaseProcessor:
+    """
+    The state, bookkeeping and actions shared by Processor and AsyncProcessor (see async_processor.py).  Subclasses
+    provide the ways of processing payments, and differ in whether those are called directly or awaited, so code
+    written for one kind of processor cannot be handed the other.
+    """
+    def __init__(self, database, sink=None, instrumentation=None, idempotency=None):
         """
         :param database: A reference to the previously created system database.
+        :param sink: The ActionSink that will receive a record of every action taken.  Defaults to a PrintSink.
+        :param instrumentation: If given, an Instrumentation (see instrumentation.py) that will record the time spent
+        in each phase and action of every payment processed.
+        :param idempotency: If given, an IdempotencyIndex (see idempotency.py).  Any payment duplicating an order
+        already in the index is skipped rather than processed, and every payment processed successfully is added to it.
         """
         self.database = database
+        self.sink = PrintSink() if sink is None else sink
+        self.instrumentation = instrumentation
+        self.idempotency = idempotency
+        if instrumentation is not None:
+            instrumentation.attach(self)
 
-    def process_payments(self, arg):
+    def flush(self):
         """
-        Process either a single payment, or an iterable of several
-        :param arg: Either a single Payment object, or an iterable of such objects
-        :return: Either a list of payments that failed, if a list was given, or a single payment that failed,
-        if only one was provided.  May be an empty list or none if there were no failures.
+        Flush anything the processor is holding back, such as buffered action records.  Called automatically at the
+        end of process_payments, but must be called after processing payments one at a time with process_payment.
         """
-        if isinstance(arg, Payment):
-            return self.process_payment(arg)
-        else:
-            failed_orders = []
-            for each in arg:
-                result = self.process_payment(each)
-                if result is not None:
-                    failed_orders.append(result)
-            return failed_orders
+        self.sink.flush()
+        if self.idempotency is not None:
+            self.idempotency.commit()
 
-    def process_payment(self, payment):
+    def _begin_payment(self, payment):
         """
-        Process a single payment
-        :param payment: The payment to process
-        :return: the payment, if processing failed, or None if it succeeded
+        Bookkeeping shared by every way of processing a payment, performed before any of its steps are run.
         """
-        failed_order = None
-
-        print(f"Beginning processing of payment of ${payment.value:.2f} with id# {payment.payment_id}.")
+        self.sink.record(payment.payment_id, "begin", (payment.value,))
         if payment.payment_id in self.database.processed_orders.keys():
-            print("Processor received payment with duplicate ID - Not allowed.")
-        try:
-            payment.process_begin(self)
-            payment.process_middle(self)
-            payment.process_end(self)
-        except Exception as e:
-            failed_order = payment
-            self.database.failed_orders[payment.payment_id] = payment
-            print(" X Unhandled exception raised during processing!")
-            print(f"    > {e}")
-            print(f" - Processing aborted!\n")
-        else:
-            self.database.processed_orders[payment.payment_id] = payment
-            self.database.failed_orders.pop(payment.payment_id, None)
-            print(f" - Processing completed!\n")
+            self.sink.record(payment.payment_id, "duplicate_id")
+
+    def _fail_payment(self, payment, e):
+        """
+        Archive a payment whose processing raised an exception.
 
+        :return: the failed payment
+        """
+        self.database.failed_orders[payment.payment_id] = payment
+        self.sink.record(payment.payment_id, "failed", (str(e),))
+        return payment
 
-        return failed_order
+    def _complete_payment(self, payment, key=None):
+        """
+        Archive a payment that was processed successfully.
+
+        :param key: The digest returned for the payment by the idempotency index, if there is one.
+        """
+        self.database.processed_orders[payment.payment_id] = payment
+        self.database.failed_orders.pop(payment.payment_id, None)
+        if key is not None:
+            self.idempotency.add(key)
+        self.sink.record(payment.payment_id, "completed")
 
     def generate_packing_slip(self, payment):
         """
@@ -71,7 +87,7 @@ class Processor:
             product_id
             shipping_address
         """
-        print(f" | Generate packing slip for product {payment.product_id} to address :{payment.shipping_address}.")
+        self.sink.record(payment.payment_id, "packing_slip", (payment.product_id, payment.shipping_address))
 
     def generate_commission(self, payment):
         """
@@ -85,9 +101,9 @@ class Processor:
         """
         commission = round(self.database.commission_table[payment.product_id] * payment.value, 2)
         if commission > 0.0 and payment.agent is not None:
-            print(f" | Generate commission for agent {payment.agent} for ${commission:.2f}.")
+            self.sink.record(payment.payment_id, "commission", (payment.agent, commission))
         else:
-            print(f" | Checking... no commission due.")
+            self.sink.record(payment.payment_id, "no_commission")
 
     def generate_royalty_packing_slip(self, payment):
         """
@@ -97,8 +113,7 @@ class Processor:
             product_id
             shipping_address
         """
-        print(f" | Generate royalty department packing slip for product {payment.product_id} to address: "
-              f"{payment.shipping_address}.")
+        self.sink.record(payment.payment_id, "royalty_packing_slip", (payment.product_id, payment.shipping_address))
 
     def send_membership_email(self, payment):
         """
@@ -110,11 +125,9 @@ class Processor:
             member_id
         """
         if payment.membership_payment_type == "upgrade":
-            print(f" | Send email to user user {payment.member_id} that their {payment.membership_id} has been "
-                  f"upgraded.")
+            self.sink.record(payment.payment_id, "upgrade_email", (payment.member_id, payment.membership_id))
         else: # this is for an activation
-            print(f" | Send activation email to user user {payment.member_id} for their {payment.membership_id} "
-                  f"membership.")
+            self.sink.record(payment.payment_id, "activation_email", (payment.member_id, payment.membership_id))
 
     def upgrade_membership(self, payment):
         """
@@ -124,7 +137,7 @@ class Processor:
             membership_id
             member_id
         """
-        print(f" | Upgrade membership of type {payment.membership_id} for user {payment.member_id}.")
+        self.sink.record(payment.payment_id, "upgrade_membership", (payment.membership_id, payment.member_id))
 
     def activate_membership(self, payment):
         """
@@ -134,15 +147,202 @@ class Processor:
             membership_id
             member_id
         """
-        print(f" | Activate membership of type {payment.membership_id} for user {payment.member_id}.")
+        self.sink.record(payment.payment_id, "activate_membership", (payment.membership_id, payment.member_id))
 
-    def video_addon(self, add_on):
+    def video_addon(self, payment, add_on):
         """
         Include an add-on to a video payment.
 
         Requires following payment attributes:
             ---
         """
-        print(f" | Including add-on to packing slip: {add_on}")
+        self.sink.record(payment.payment_id, "video_addon", (add_on,))
+
+class Processor(BaseProcessor):
+    """
+    Processor that runs each payment to completion before starting the next.
+    """
+    def process_payments(self, arg, workers=None, shard_key="payment_id", chunk_size=1000):
+        """
+        Process either a single payment, or an iterable of several
+        :param arg: Either a single Payment object, or an iterable of such objects
+        :param workers: If given, split an iterable of payments into shards and process them in parallel across a
+        pool of this many worker processes.  Results are merged back into the database in the original order of the
+        iterable, so the archive and the returned list of failures are the same as for serial processing.
+        :param shard_key: The payment attribute used to assign payments to shards when processing in parallel, e.g.
+        'payment_id' or 'product_id'.  Payments that lack the attribute are sharded by payment_id.
+        :param chunk_size: The maximum number of payments sent to a worker process at once.
+        :return: Either a list of payments that failed, if a list was given, or a single payment that failed,
+        if only one was provided.  May be an empty list or none if there were no failures.
+        """
+        if isinstance(arg, Payment):
+            return self.process_payment(arg)
+        elif workers is not None:
+            return self._process_payments_parallel(arg, workers, shard_key, chunk_size)
+        else:
+            return list(self.iter_failures(arg))
+
+    def iter_failures(self, payments):
+        """
+        Process an iterable of payments lazily, one at a time, as it is consumed.  Neither the payments nor the
+        failures are ever collected into a list, so this can be used to stream arbitrarily many payments through the
+        processor.
+        :param payments: An iterable of Payment objects.  It is only advanced as the failures are consumed.
+        :return: A generator yielding each payment that failed, as soon as it fails.
+        """
+        for each in payments:
+            result = self.process_payment(each)
+            if result is not None:
+                yield result
+        self.flush()
+
+    def _process_payments_parallel(self, arg, workers, shard_key, chunk_size):
+        """
+        Parallel implementation of process_payments.  Payments are sharded by a stable hash of shard_key, so that
+        every payment with the same key is handled by the same worker, and each shard is sent to the pool in chunks.
+        Each chunk holds payments of a single class, and is handed over as a binary batch in shared memory (see
+        binary.py), so that workers read the payments without unpickling them.  Chunks the binary format cannot hold
+        are pickled instead.  The workers only run the steps of each payment and report back.  All bookkeeping,
+        including the duplicate ID check and every write to the database, happens here in the parent, so the workers
+        never touch the archive.
+        """
+        payments = list(arg)
+        # Payments already known to be duplicates are not sent to the workers at all.  Since the index is only added
+        # to during the merge, those payments are certain to still be duplicates there.
+        if self.idempotency is None:
+            skipped = [False] * len(payments)
+        else:
+            skipped = [self.idempotency.check(payment) is None for payment in payments]
+
+        # Each shard is split by payment class, since a binary batch only holds payments of one class.
+        shards = [{} for _ in range(workers)]
+        for index, payment in enumerate(payments):
+            if skipped[index]:
+                continue
+            key = getattr(payment, shard_key, payment.payment_id)
+            shard = shards[zlib.crc32(str(key).encode()) % workers]
+            shard.setdefault(declared_class(type(payment)), []).append(index)
+
+        chunks = [
+            indices[start:start + chunk_size]
+            for shard in shards for indices in shard.values() for start in range(0, len(indices), chunk_size)
+        ]
+        # The workers record their actions in memory, to be replayed into the real sink in order once merged.
+        worker_processor = copy.copy(self)
+        worker_processor.sink = MemorySink()
+        worker_processor.idempotency = None
+        if self.instrumentation is not None:
+            self.instrumentation.detach(worker_processor)
+            worker_processor.instrumentation = None
+        blocks = []
+
+        def tasks():
+            for chunk in chunks:
+                chunk_payments = [payments[index] for index in chunk]
+                try:
+                    block = binary.write_shared(chunk_payments)
+                except ValueError:
+                    yield worker_processor, chunk_payments
+                else:
+                    blocks.append(block)
+                    yield worker_processor, block.name
+
+        results = [None] * len(payments)
+        # Workers must share the resource tracker of this process, or each would start its own, which would treat the
+        # blocks it opened as leaked and unlink them when the worker exits.
+        resource_tracker.ensure_running()
+        try:
+            with Pool(workers) as pool:
+                for chunk, chunk_results in zip(chunks, pool.imap(_process_chunk, tasks())):
+                    for index, result in zip(chunk, chunk_results):
+                        results[index] = result
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        # Merge in the original order, so the output and archive are deterministic regardless of scheduling.  Any
+        # duplicates within the input itself are only caught here, so their results are discarded.
+        failed_orders = []
+        for payment, result in zip(payments, results):
+            key = None
+            if self.idempotency is not None:
+                key = self.idempotency.check(payment)
+                if key is None:
+                    self.sink.record(payment.payment_id, "duplicate_skipped")
+                    continue
+            error, records = result
+            self._begin_payment(payment)
+            for record in records:
+                self.sink.record(*record)
+            if error is not None:
+                failed_orders.append(self._fail_payment(payment, error))
+            else:
+                self._complete_payment(payment, key)
+        self.flush()
+        return failed_orders
+
+    def process_payment(self, payment):
+        """
+        Process a single payment
+        :param payment: The payment to process
+        :return: the payment, if processing failed, or None if it succeeded
+        """
+        key = None
+        if self.idempotency is not None:
+            key = self.idempotency.check(payment)
+            if key is None:
+                self.sink.record(payment.payment_id, "duplicate_skipped")
+                return None
+
+        self._begin_payment(payment)
+        try:
+            if self.instrumentation is None:
+                compile_plan(type(payment)).run(payment, self)
+            else:
+                self.instrumentation.run_plan(compile_plan(type(payment)), payment, self)
+        except Exception as e:
+            return self._fail_payment(payment, e)
+        else:
+            self._complete_payment(payment, key)
+            return None
+
+def require_sync(processor):
+    """
+    Raise a TypeError if a processor processes payments asynchronously, such as an AsyncProcessor, whose
+    process_payment returns a coroutine rather than a result.  Called by the code that drives a processor
+    synchronously, which would otherwise take every coroutine for a failed payment, and process nothing.
+    """
+    if inspect.iscoroutinefunction(processor.process_payment):
+        raise TypeError(
+            f"Invalid argument: {type(processor).__name__} processes payments asynchronously, and must be awaited."
+        )
 
+def _process_chunk(task):
+    """
+    Worker side of Processor.process_payments in parallel mode.  Runs the action plan of each payment in a chunk and
+    reports, for each one, the error message if it failed and the action records its steps produced.
 
+    :param task: A tuple of (processor, payments), where payments is either a list of payments, or the name of a
+    shared memory block holding them as a binary batch.
+    :return: A list of (error, records) tuples, in the same order as the payments.  error is None for success.
+    """
+    processor, payments = task
+    batch = None
+    if isinstance(payments, str):
+        batch = payments = binary.open_shared(payments, processor.database)
+    results = []
+    try:
+        for payment in payments:
+            try:
+                compile_plan(type(payment)).run(payment, processor)
+            except Exception as e:
+                error = str(e)
+            else:
+                error = None
+            results.append((error, processor.sink.records))
+            processor.sink.records = []
+    finally:
+        if batch is not None:
+            batch.close()
+    return results
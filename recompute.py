@@ -0,0 +1,82 @@
+"""
+Recompute the commissions of archived payments after a change to the commission table, without reprocessing the
+archive.  Only the products whose rate actually changed are looked at, and only the payments for those products are
+recomputed, found through the product_id index of the archive (see archive.py and sqlite_database.py).
+
+A change to the default rate of the table affects every product the table does not list, so when the default changes,
+every such product in the archive is included.
+
+Commissions are recomputed exactly as Processor.generate_commission computes them, for every archived payment with
+value, product_id and agent fields, and deltas are summed in whole cents, so they are exact.  Nothing is written: the
+result is only a report of what would change.
+"""
+
+def table_default(table):
+    """
+    :param table: A lookup table, either a defaultdict or an SQLiteLookupTable.
+    :return: The value the table gives for keys it does not contain, or None if it has no default.
+    """
+    if hasattr(table, "default_factory"):
+        return None if table.default_factory is None else table.default_factory()
+    return getattr(table, "default", None)
+
+def _rate(table, default, product_id):
+    # Membership is tested first, since indexing a defaultdict would insert the missing key.
+    return table[product_id] if product_id in table else default
+
+def changed_products(archive, old_table, new_table):
+    """
+    Find every product in an archive whose commission rate differs between two versions of the commission table.
+
+    :param archive: The archive of payments, e.g. database.processed_orders.
+    :param old_table: The commission table before the change, e.g. a copy taken before editing it.
+    :param new_table: The commission table after the change.
+    :return: A dict mapping each affected product_id to a tuple of its (old rate, new rate).
+    """
+    old_default, new_default = table_default(old_table), table_default(new_table)
+    candidates = set(old_table) | set(new_table)
+    if old_default != new_default:
+        candidates.update(archive.products())
+
+    changes = {}
+    for product_id in candidates:
+        old_rate = _rate(old_table, old_default, product_id)
+        new_rate = _rate(new_table, new_default, product_id)
+        if old_rate != new_rate:
+            changes[product_id] = (old_rate, new_rate)
+    return changes
+
+def _commission_cents(rate, value, agent):
+    # Mirrors Processor.generate_commission: nothing is due without an agent or with a rate that rounds to nothing.
+    commission = round(rate * value, 2)
+    return round(commission * 100) if commission > 0.0 and agent is not None else 0
+
+def recompute_commissions(archive, old_table, new_table):
+    """
+    Recompute the commission of every archived payment affected by a change to the commission table.
+
+    :param archive: The archive of payments, e.g. database.processed_orders.  Must support ids_for_product and
+    products, as OrderArchive and SQLiteOrderArchive do.
+    :param old_table: The commission table before the change.
+    :param new_table: The commission table after the change.
+    :return: A tuple of (deltas, changes).  deltas maps each agent whose commission total changed to the amount it
+    changed by.  changes is a list of (payment_id, agent, old commission, new commission) tuples, one for each payment
+    whose commission changed, in ascending order of payment_id within each product.  A commission that is not due
+    is given as 0.0.
+    """
+    delta_cents = {}
+    changes = []
+    for product_id, (old_rate, new_rate) in changed_products(archive, old_table, new_table).items():
+        for payment_id in archive.ids_for_product(product_id):
+            record = archive[payment_id]
+            value = getattr(record, "value", None)
+            if value is None or not hasattr(record, "agent"):
+                continue
+            old_cents = _commission_cents(old_rate, value, record.agent)
+            new_cents = _commission_cents(new_rate, value, record.agent)
+            if old_cents != new_cents:
+                changes.append((payment_id, record.agent, old_cents / 100, new_cents / 100))
+                delta_cents[record.agent] = delta_cents.get(record.agent, 0) + new_cents - old_cents
+
+    deltas = {agent: cents / 100 for agent, cents in delta_cents.items() if cents}
+    return deltas, changes
@@ -0,0 +1,176 @@
+"""
+Define a scheduler that retries failed payments.  A payment that raises during processing is archived in
+database.failed_orders, and stays there until something processes it again.  Many failures are transient, such as a
+backend that was briefly unavailable, so the retry scheduler picks up every payment in failed_orders and re-queues it
+to be processed again after a delay, which grows exponentially with each failed attempt.  Each delay is randomly
+shortened by up to a fraction given by the jitter of the policy, so that payments which failed together are not all
+retried at the same moment.
+
+Due payments are re-created from their archive records and retried in batches through Processor.process_payments, so
+they are processed exactly like new payments, keep their original payment_id, and are removed from failed_orders by
+the processor when they succeed.  A payment that fails max_attempts times in total, counting the original attempt, is
+moved from failed_orders to database.dead_letters for an operator to look into, and is not retried again.  If the
+processor has an idempotency index, a retried payment may instead be skipped as a duplicate of an order that has since
+been processed under another payment_id.  The processor leaves such a payment in failed_orders, so the scheduler
+removes it, since there is nothing left to retry.
+
+The scheduler keeps its queue and attempt counts in memory, so after a restart every payment still in failed_orders
+starts over with a fresh count.
+"""
+
+import heapq
+import random
+import time
+
+from processor import require_sync
+
+class RetryPolicy:
+    """
+    When and how many times to retry a failed payment.
+    """
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=300.0, multiplier=2.0, jitter=0.5):
+        """
+        :param max_attempts: The maximum number of times a payment is processed in total, including the original
+        attempt, before it is dead lettered.
+        :param base_delay: The delay, in seconds, before the first retry.
+        :param max_delay: The longest delay, in seconds, before any retry.
+        :param multiplier: The factor the delay grows by after each failed retry.
+        :param jitter: The largest fraction of each delay that may be randomly taken off it, between 0 and 1.
+        """
+        if max_attempts < 1:
+            raise ValueError("Invalid argument: max_attempts must be at least 1.")
+        if not 0.0 <= jitter <= 1.0:
+            raise ValueError("Invalid argument: jitter must be between 0 and 1.")
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def delay(self, attempts, rng=random):
+        """
+        :param attempts: The number of times the payment has been processed so far.
+        :param rng: The source of randomness for the jitter.
+        :return: The delay in seconds before the next attempt.
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempts - 1))
+        return delay * (1.0 - self.jitter * rng.random())
+
+class RetryScheduler:
+    """
+    Retries the payments in the failed_orders archive of a processor's database.  Call collect to queue newly failed
+    payments, and run_due to retry those whose delay has passed, or call run to do both until nothing is left.
+    """
+    def __init__(self, processor, policy=None, batch_size=100, clock=time.monotonic, rng=None):
+        """
+        :param processor: The processor to retry payments with.  Its database holds failed_orders and dead_letters.
+        :param policy: The RetryPolicy to follow.  Defaults to a RetryPolicy with default settings.
+        :param batch_size: The maximum number of payments retried in a single call to process_payments.
+        :param clock: A function returning the current time in seconds.
+        :param rng: A random.Random to draw jitter from.  Defaults to a new, unseeded one.
+        """
+        require_sync(processor)
+        self.processor = processor
+        self.database = processor.database
+        self.policy = RetryPolicy() if policy is None else policy
+        self.batch_size = batch_size
+        self.clock = clock
+        self.rng = random.Random() if rng is None else rng
+        # A heap of (due time, payment_id), and the number of times each queued payment has been processed.
+        self._queue = []
+        self._attempts = {}
+
+    def __len__(self):
+        """
+        :return: The number of payments queued for retry.
+        """
+        return len(self._attempts)
+
+    def collect(self):
+        """
+        Queue every payment in failed_orders that is not already queued, as having been processed once.
+
+        :return: The number of payments newly queued.
+        """
+        queued = 0
+        for payment_id in list(self.database.failed_orders):
+            if payment_id not in self._attempts:
+                self._schedule(payment_id, 1)
+                queued += 1
+        return queued
+
+    def _schedule(self, payment_id, attempts):
+        self._attempts[payment_id] = attempts
+        heapq.heappush(self._queue, (self.clock() + self.policy.delay(attempts, self.rng), payment_id))
+
+    def next_due(self):
+        """
+        :return: The time at which the next queued payment is due, or None if nothing is queued.
+        """
+        return self._queue[0][0] if self._queue else None
+
+    def run_due(self):
+        """
+        Retry every queued payment whose delay has passed, in batches of at most batch_size.
+
+        :return: A tuple of (number of payments retried, number that succeeded, number dead lettered, number skipped as
+        duplicates).
+        """
+        retried = succeeded = dead = skipped = 0
+        now = self.clock()
+        while self._queue and self._queue[0][0] <= now:
+            batch = []
+            while self._queue and self._queue[0][0] <= now and len(batch) < self.batch_size:
+                _, payment_id = heapq.heappop(self._queue)
+                record = self.database.failed_orders.get(payment_id)
+                if record is None:
+                    # Processed successfully by something else since it was queued.
+                    del self._attempts[payment_id]
+                else:
+                    batch.append(record.to_payment(self.database))
+            if not batch:
+                continue
+
+            failed = {payment.payment_id for payment in self.processor.process_payments(batch)}
+            retried += len(batch)
+            for payment in batch:
+                payment_id = payment.payment_id
+                attempts = self._attempts.pop(payment_id) + 1
+                if payment_id not in failed:
+                    if payment_id in self.database.failed_orders:
+                        # Skipped as a duplicate, since a completed payment is always removed from failed_orders.
+                        del self.database.failed_orders[payment_id]
+                        skipped += 1
+                    else:
+                        succeeded += 1
+                elif attempts >= self.policy.max_attempts:
+                    self._dead_letter(payment_id, attempts)
+                    dead += 1
+                else:
+                    self._schedule(payment_id, attempts)
+        self.processor.flush()
+        return retried, succeeded, dead, skipped
+
+    def _dead_letter(self, payment_id, attempts):
+        self.database.dead_letters[payment_id] = self.database.failed_orders.pop(payment_id)
+        self.processor.sink.record(payment_id, "dead_letter", (attempts,))
+
+    def run(self, sleep=time.sleep):
+        """
+        Collect and retry failed payments, waiting between retries, until every queued payment has either succeeded or
+        been dead lettered.
+
+        :param sleep: A function taking a number of seconds to wait for.
+        :return: A tuple of (number of payments retried, number that succeeded, number dead lettered, number skipped as
+        duplicates), in total.
+        """
+        totals = [0, 0, 0, 0]
+        self.collect()
+        while self._queue:
+            wait = self.next_due() - self.clock()
+            if wait > 0:
+                sleep(wait)
+            for i, count in enumerate(self.run_due()):
+                totals[i] += count
+            self.collect()
+        return tuple(totals)
@@ -0,0 +1,199 @@
+"""
+Define a scheduler that sits in front of the processor, so that one processor can serve bulk imports and interactive
+traffic at once.  Processor.process_payments works through payments strictly in the order given, so a large import of
+PhysicalProduct or Book payments holds up every Membership activation queued behind it, with customers waiting.
+
+The scheduler keeps a separate queue for each payment class, and decides which queue to serve next by weighted fair
+queueing: over time, each non-empty queue is served in proportion to its weight, so a queue with weight 4 is served four
+times as often as one with weight 1, however deep either backlog is.  A queue that sits empty builds up no credit, so it
+cannot starve the others when it fills up again.
+
+Each queue may also have a latency target, in seconds.  Whenever the payment at the head of a queue has waited longer
+than its target, that queue is served next, ahead of the weighted order.  When several are late, the one furthest past
+its target, relative to the target, goes first.
+
+For each queue the scheduler counts payments submitted and processed, and keeps a histogram of the time payments spent
+waiting (see instrumentation.py).  Read them with metrics.
+"""
+
+import threading
+import time
+from collections import deque
+
+from instrumentation import LatencyHistogram
+from payment import declared_class
+from processor import require_sync
+
+class PaymentQueue:
+    """
+    The queue, settings and metrics for a single payment class.
+    """
+    def __init__(self, name, weight, latency_target):
+        self.name = name
+        self.weight = weight
+        self.latency_target = latency_target
+        self.items = deque()
+        self.submitted = 0
+        self.processed = 0
+        self.late = 0
+        self.wait = LatencyHistogram()
+        # The virtual time at which this queue is next due to be served, for weighted fair queueing.
+        self.virtual_time = 0.0
+
+    def snapshot(self, now):
+        """
+        :return: A dict of the metrics of the queue.
+        """
+        return {
+            "weight": self.weight,
+            "latency_target": self.latency_target,
+            "depth": len(self.items),
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "late": self.late,
+            "oldest_wait_s": now - self.items[0][0] if self.items else 0.0,
+            "wait": self.wait.snapshot(),
+        }
+
+class PaymentScheduler:
+    """
+    Queues payments by class and feeds them to a processor in weighted fair order.  Payments may be submitted from any
+    thread, while another runs the scheduler.
+    """
+    def __init__(self, processor, weights=None, latency_targets=None, default_weight=1.0, clock=time.monotonic):
+        """
+        :param processor: The processor to feed payments to.
+        :param weights: A dict mapping payment class names to weights.  Classes not given have default_weight.
+        :param latency_targets: A dict mapping payment class names to the longest time, in seconds, their payments
+        should wait in the queue.  Classes not given have no target.
+        :param default_weight: The weight of any class not in weights.
+        :param clock: A function returning the current time in seconds.
+        """
+        require_sync(processor)
+        self.processor = processor
+        self.weights = {} if weights is None else dict(weights)
+        self.latency_targets = {} if latency_targets is None else dict(latency_targets)
+        if any(weight <= 0 for weight in self.weights.values()) or default_weight <= 0:
+            raise ValueError("Invalid argument: every weight must be positive.")
+        self.default_weight = default_weight
+        self.clock = clock
+        self.queues = {}
+        self._virtual_time = 0.0
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def _queue(self, name):
+        try:
+            return self.queues[name]
+        except KeyError:
+            queue = self.queues[name] = PaymentQueue(
+                name, self.weights.get(name, self.default_weight), self.latency_targets.get(name)
+            )
+            return queue
+
+    def submit(self, payment):
+        """
+        Queue a payment to be processed.
+        """
+        with self._condition:
+            queue = self._queue(declared_class(type(payment)).__name__)
+            if not queue.items:
+                # A queue that has been idle starts from the present, rather than with credit from its time idle.
+                queue.virtual_time = max(queue.virtual_time, self._virtual_time)
+            queue.items.append((self.clock(), payment))
+            queue.submitted += 1
+            self._pending += 1
+            self._condition.notify()
+
+    def submit_many(self, payments):
+        """
+        Queue every payment in an iterable.
+        """
+        for payment in payments:
+            self.submit(payment)
+
+    def __len__(self):
+        """
+        :return: The number of payments waiting in every queue.
+        """
+        return self._pending
+
+    def _next(self):
+        """
+        Take the next payment to process, which must exist.
+
+        :return: A tuple of (queue, time queued, payment).
+        """
+        now = self.clock()
+        chosen = None
+        lateness = 1.0
+        for queue in self.queues.values():
+            if queue.items and queue.latency_target is not None:
+                ratio = (now - queue.items[0][0]) / queue.latency_target if queue.latency_target else float("inf")
+                if ratio > lateness:
+                    chosen, lateness = queue, ratio
+        if chosen is None:
+            chosen = min((queue for queue in self.queues.values() if queue.items), key=lambda q: q.virtual_time)
+        else:
+            chosen.late += 1
+
+        queued, payment = chosen.items.popleft()
+        self._virtual_time = chosen.virtual_time
+        chosen.virtual_time += 1.0 / chosen.weight
+        self._pending -= 1
+        return chosen, queued, payment
+
+    def run(self, limit=None):
+        """
+        Process queued payments until every queue is empty, or limit payments have been processed.
+
+        :param limit: The maximum number of payments to process, or None for no limit.
+        :return: A list of the payments that failed.
+        """
+        failed_orders = []
+        count = 0
+        while limit is None or count < limit:
+            with self._condition:
+                if not self._pending:
+                    break
+                queue, queued, payment = self._next()
+            failed_orders += self._process(queue, queued, payment)
+            count += 1
+        self.processor.flush()
+        return failed_orders
+
+    def serve(self, stop, poll_interval=0.1):
+        """
+        Process payments as they are submitted, until stop is set.  Meant to be run on its own thread.
+
+        :param stop: A threading.Event, set to stop serving once the queues are empty.
+        :param poll_interval: The longest time, in seconds, to wait for a payment before checking stop again.
+        :return: A list of the payments that failed.
+        """
+        failed_orders = []
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self.processor.flush()
+                    if stop.is_set():
+                        return failed_orders
+                    self._condition.wait(poll_interval)
+                queue, queued, payment = self._next()
+            failed_orders += self._process(queue, queued, payment)
+
+    def _process(self, queue, queued, payment):
+        queue.wait.record(int((self.clock() - queued) * 1e9))
+        result = self.processor.process_payment(payment)
+        queue.processed += 1
+        return [] if result is None else [result]
+
+    def metrics(self):
+        """
+        :return: A dict mapping each payment class name to a dict of the metrics of its queue: its weight and
+        latency_target, depth (payments waiting), counts of payments submitted, processed, and served late, ahead of
+        the weighted order, the wait of the oldest payment waiting, and a histogram of waits (see
+        LatencyHistogram.snapshot).
+        """
+        with self._condition:
+            now = self.clock()
+            return {name: queue.snapshot(now) for name, queue in self.queues.items()}
@@ -0,0 +1,280 @@
+"""
+Simulate proposed changes to the lookup tables over the whole order archive, to see their financial impact before making
+them.  Running every archived payment back through the processor under the proposed rules would take far too long, and
+would write to the database and the sinks.  Instead, the archive is loaded once into columns, as in batch.py, and each
+set of tables is evaluated over every payment at once in a few vectorized passes.  Nothing is written anywhere, and the
+tables are only read, so even a defaultdict is never given new keys.
+
+The archive is held as an ArchiveColumns, with a code into a list of distinct values in place of each payment class,
+product_id and agent, so each table is only consulted once per distinct product.  Loading a large archive record by
+record is the slow part, so save the columns once and load them back for each later simulation.
+
+For each set of tables, simulate computes, for each payment:
+
+    commission  exactly as Processor.generate_commission would, for every payment with value, product_id and agent
+                fields, including which have no commission due because of a zero rate or a missing agent
+    priced      the price_table price of its product, for every payment with a product_id, i.e. what the archived
+                orders would have been charged at those prices
+    add_on      whether a Video payment would be sent an add-on by video_addons, and which
+
+and totals them per agent, per product and per payment type.  compare simulates the current and the proposed tables
+and also gives the difference between every total.  Commissions are totaled in whole cents, so they are exact.
+
+This requires numpy, which the rest of the system does not.
+"""
+
+import numpy as np
+
+from batch import round_cents
+from payment import Video, find_payment_class, payment_fields
+from recompute import table_default
+from tables import TABLES
+
+# The totals kept for each agent, product and payment type, in the order of the rows of the arrays of _sums.
+TOTALS = ("payments", "value", "priced", "commissions", "commission", "add_ons")
+
+class ArchiveColumns:
+    """
+    The payments of an archive, stored as columns.  Should be treated as immutable once constructed.
+
+    Columns:
+        payment_ids     int64 array of payment ids
+        values          float64 array of payment values, 0 where a payment has no value
+        type_codes      int64 array of indices into types
+        types           list of the distinct payment classes in the archive
+        product_codes   int64 array of indices into products, -1 where a payment has no product_id
+        products        list of the distinct product_ids in the archive
+        agent_codes     int64 array of indices into agents, -1 where a payment has no agent
+        agents          list of the distinct agents in the archive
+    """
+    def __init__(self, payment_ids, values, type_codes, types, product_codes, products, agent_codes, agents):
+        """
+        Construct the columns directly.  Usually from_archive or load is more convenient.
+        """
+        self.payment_ids = np.asarray(payment_ids, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.type_codes = np.asarray(type_codes, dtype=np.int64)
+        self.types = list(types)
+        self.product_codes = np.asarray(product_codes, dtype=np.int64)
+        self.products = list(products)
+        self.agent_codes = np.asarray(agent_codes, dtype=np.int64)
+        self.agents = list(agents)
+        columns = (self.payment_ids, self.values, self.type_codes, self.product_codes, self.agent_codes)
+        if len({len(column) for column in columns}) > 1:
+            raise ValueError("Invalid argument: every column of ArchiveColumns must be the same length.")
+
+    def __len__(self):
+        return len(self.payment_ids)
+
+    @classmethod
+    def from_archive(cls, archive):
+        """
+        Load the records of an archive into columns.
+
+        :param archive: The archive, e.g. database.processed_orders, or any iterable of archive records.
+        :return: An ArchiveColumns.
+        """
+        records = archive.values() if hasattr(archive, "values") else archive
+        payment_ids, values, type_codes, product_codes, agent_codes = [], [], [], [], []
+        types, products, agents = {}, {}, {}
+        # For each record class, its type code and the positions of its value, product_id and agent fields.
+        layouts = {}
+        for record in records:
+            try:
+                type_code, value_at, product_at, agent_at = layouts[type(record)]
+            except KeyError:
+                fields = record._fields
+                type_code = types.setdefault(record.payment_class, len(types))
+                value_at, product_at, agent_at = (
+                    fields.index(field) if field in fields else None for field in ("value", "product_id", "agent")
+                )
+                layouts[type(record)] = (type_code, value_at, product_at, agent_at)
+
+            payment_ids.append(record.payment_id)
+            type_codes.append(type_code)
+            value = None if value_at is None else record[value_at]
+            values.append(0.0 if value is None else value)
+            product = None if product_at is None else record[product_at]
+            product_codes.append(-1 if product is None else products.setdefault(product, len(products)))
+            agent = None if agent_at is None else record[agent_at]
+            agent_codes.append(-1 if agent is None else agents.setdefault(agent, len(agents)))
+
+        return cls(payment_ids, values, type_codes, types, product_codes, products, agent_codes, agents)
+
+    def save(self, path):
+        """
+        Save the columns to a numpy .npz file, to be read back with load.
+        """
+        np.savez(
+            path,
+            payment_ids=self.payment_ids,
+            values=self.values,
+            type_codes=self.type_codes,
+            types=np.array([cls.__name__ for cls in self.types], dtype=str),
+            product_codes=self.product_codes,
+            products=np.array(self.products, dtype=str),
+            agent_codes=self.agent_codes,
+            agents=np.array(self.agents, dtype=str),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load columns saved by save.
+
+        :return: An ArchiveColumns.
+        """
+        with np.load(path) as data:
+            return cls(
+                data["payment_ids"],
+                data["values"],
+                data["type_codes"],
+                [find_payment_class(name) for name in data["types"].tolist()],
+                data["product_codes"],
+                data["products"].tolist(),
+                data["agent_codes"],
+                data["agents"].tolist(),
+            )
+
+def _lookup(table, name, products):
+    """
+    Look up every product in a table, without adding missing products to it.
+
+    :return: A float64 array of the value of each product.
+    """
+    default = table_default(table)
+    looked_up = []
+    for product in products:
+        if product in table:
+            looked_up.append(table[product])
+        elif default is not None:
+            looked_up.append(default)
+        else:
+            raise ValueError(f"Invalid argument: {name} has no entry for product {product}, and no default.")
+    return np.array(looked_up, dtype=np.float64)
+
+def _sums(keys, size, per_payment):
+    """
+    Sum each per payment column over the payments with each key.
+
+    :param keys: An int64 array of the key of each payment, in range(size).
+    :param per_payment: A list of arrays, one for each of TOTALS after payments.
+    :return: A float64 array with a row for each of TOTALS and a column for each key.
+    """
+    rows = [np.bincount(keys, minlength=size)]
+    rows += [np.bincount(keys, weights=column, minlength=size) for column in per_payment]
+    return np.array(rows, dtype=np.float64)
+
+def _report(sums):
+    """
+    :param sums: A column of the array of _sums.
+    :return: A dict of the totals of the column, with commission converted from cents.
+    """
+    payments, value, priced, commissions, commission, add_ons = sums.tolist()
+    return {
+        "payments": int(payments),
+        "value": round(value, 2),
+        "priced": round(priced, 2),
+        "commissions": int(commissions),
+        "commission": int(commission) / 100,
+        "add_ons": int(add_ons),
+    }
+
+def simulate(columns, tables, **proposed):
+    """
+    Evaluate a set of lookup tables over every payment in an archive.
+
+    :param columns: The ArchiveColumns of the archive.
+    :param tables: Any database, or TableSnapshot, with the three lookup tables.
+    :param proposed: Tables to use in place of those of tables, by name, e.g. commission_table={...}.
+    :return: A dict of totals: per_agent, per_product and per_payment_type, each a dict mapping the agent, product_id or
+    payment class name to a dict of totals, and totals, a dict of totals over every payment.  Each dict of totals holds
+    the count of payments, their total value, their total priced at price_table, the count that have a commission
+    due, the total commission due, and the count that would be sent an add-on.  Also add_ons, a dict mapping each
+    add-on product to the count of payments that would be sent it.
+    """
+    unknown = set(proposed) - set(TABLES)
+    if unknown:
+        raise ValueError(f"Invalid argument: unknown tables {sorted(unknown)}.")
+    commission_table, price_table, video_addons = (
+        proposed.get(name, getattr(tables, name, None)) for name in ("commission_table", "price_table", "video_addons")
+    )
+
+    # Each table is looked up once per product, into an array with an extra last entry for the product code -1, so
+    # that a single gather by product code finds the entry of every payment.
+    classes = columns.types
+    product_codes, type_codes = columns.product_codes, columns.type_codes
+    # A payment is commissioned if its class has value, product_id and agent fields, as in recompute.py.
+    commissioned_types = np.array(
+        [{"value", "product_id", "agent"} <= set(payment_fields(cls)) for cls in classes], dtype=bool
+    )
+    video_types = np.array([issubclass(cls, Video) for cls in classes], dtype=bool)
+
+    commission_cents = np.zeros(len(columns))
+    if len(columns.products) and commission_table is not None:
+        rates = np.append(_lookup(commission_table, "commission_table", columns.products), 0.0)[product_codes]
+        if not commissioned_types.all():
+            rates = np.where(commissioned_types[type_codes], rates, 0.0)
+        commissions = round_cents(rates * columns.values)
+        due = (commissions > 0.0) & (columns.agent_codes >= 0)
+        # Whole cents, held as floats since bincount sums floats, which are exact for any realistic total.
+        commission_cents = np.where(due, np.rint(commissions * 100.0), 0.0)
+
+    priced = np.zeros(len(columns))
+    if len(columns.products) and price_table is not None:
+        priced = np.append(_lookup(price_table, "price_table", columns.products), 0.0)[product_codes]
+
+    # Each payment that would be sent an add-on holds the code of the add-on in add_on_codes, others hold -1.
+    add_on_products = {}
+    add_on_codes = np.full(len(columns), -1, dtype=np.int64)
+    if len(columns.products) and video_addons is not None:
+        codes = np.array([
+            add_on_products.setdefault(video_addons[product], len(add_on_products)) if product in video_addons else -1
+            for product in columns.products
+        ] + [-1], dtype=np.int64)
+        add_on_codes = np.where(video_types[type_codes], codes[product_codes], -1)
+
+    # Everything is summed in just two passes: one over agents, and one over each pair of payment type and product,
+    # from which the totals per product, per payment type and overall are summed.  Codes are offset by one, so that
+    # payments with no product or agent are summed into a first column that is then dropped.
+    per_payment = (columns.values, priced, commission_cents > 0, commission_cents, add_on_codes >= 0)
+    products = len(columns.products) + 1
+    by_agent = _sums(columns.agent_codes + 1, len(columns.agents) + 1, per_payment)[:, 1:]
+    by_pair = _sums(type_codes * products + product_codes + 1, len(classes) * products, per_payment)
+    by_pair = by_pair.reshape(len(TOTALS), len(classes), products)
+    by_product = by_pair.sum(axis=1)[:, 1:]
+    by_type = by_pair.sum(axis=2)
+    add_on_counts = np.bincount(add_on_codes[add_on_codes >= 0], minlength=len(add_on_products))
+
+    return {
+        "per_agent": {agent: _report(by_agent[:, i]) for i, agent in enumerate(columns.agents)},
+        "per_product": {product: _report(by_product[:, i]) for i, product in enumerate(columns.products)},
+        "per_payment_type": {cls.__name__: _report(by_type[:, i]) for i, cls in enumerate(classes)},
+        "totals": _report(by_type.sum(axis=1)),
+        "add_ons": {product: int(count) for product, count in zip(add_on_products, add_on_counts.tolist())},
+    }
+
+def _difference(current, proposed):
+    if isinstance(current, dict) or isinstance(proposed, dict):
+        current, proposed = current or {}, proposed or {}
+        return {key: _difference(current.get(key), proposed.get(key)) for key in {**current, **proposed}}
+    difference = (proposed or 0) - (current or 0)
+    return round(difference, 2) if isinstance(difference, float) else difference
+
+def compare(columns, current, **proposed):
+    """
+    Simulate the current tables and a proposed change to them over every payment in an archive.
+
+    :param columns: The ArchiveColumns of the archive.
+    :param current: Any database, or TableSnapshot, with the three current lookup tables.
+    :param proposed: The proposed tables, by name, in place of the current ones, e.g. commission_table={...}.
+    :return: A dict of current and proposed, the results of simulate for each, and change, in the same form, holding
+    the proposed total less the current total of everything.
+    """
+    current_totals = simulate(columns, current)
+    proposed_totals = simulate(columns, current, **proposed)
+    return {
+        "current": current_totals,
+        "proposed": proposed_totals,
+        "change": _difference(current_totals, proposed_totals),
+    }
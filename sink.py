@@ -0,0 +1,204 @@
+"""
+Define the sinks that receive a record of every action the processor takes.  Rather than formatting and printing a
+line of text for each action as it happens, the processor hands each sink a compact structured record:
+
+    (payment_id, action, fields)
+
+where action is one of the strings in ACTION_FIELDS and fields is a tuple of the values named there.  What happens to
+records after that is up to the sink: they can be buffered and written out in bulk, kept in memory, thrown away, or
+formatted as human readable text.  Formatting text is only paid for by sinks that ask for it.
+
+Whenever adding a new action to the processor, add it to ACTION_FIELDS and TEXT_FORMATS below.
+"""
+
+import json
+import sys
+import threading
+
+# The names of the fields recorded for each action, in order.
+ACTION_FIELDS = {
+    "begin": ("value",),
+    "duplicate_id": (),
+    "duplicate_skipped": (),
+    "failed": ("error",),
+    "completed": (),
+    "dead_letter": ("attempts",),
+    "packing_slip": ("product_id", "shipping_address"),
+    "commission": ("agent", "commission"),
+    "no_commission": (),
+    "royalty_packing_slip": ("product_id", "shipping_address"),
+    "upgrade_email": ("member_id", "membership_id"),
+    "activation_email": ("member_id", "membership_id"),
+    "upgrade_membership": ("membership_id", "member_id"),
+    "activate_membership": ("membership_id", "member_id"),
+    "video_addon": ("add_on",),
+    "consolidated_packing_slip": ("department", "shipping_address", "items"),
+    "commission_settlement": ("agent", "total", "items"),
+    "membership_notification": ("member_id", "events"),
+}
+
+def _format_consolidated_packing_slip(payment_id, department, shipping_address, items):
+    lines = [f"Generate {department} packing slip for {len(items)} products to address: {shipping_address}.\n"]
+    for item_payment_id, product_id, add_ons in items:
+        lines.append(f" | Product {product_id} for payment id# {item_payment_id}.\n")
+        lines += [f" |  + Including add-on: {add_on}\n" for add_on in add_ons]
+    return "".join(lines) + "\n"
+
+def _format_commission_settlement(payment_id, agent, total, items):
+    lines = [f"Settle commission for agent {agent} of ${total:.2f} over {len(items)} payments.\n"]
+    lines += [f" | ${commission:.2f} for payment id# {item_payment_id}.\n" for item_payment_id, commission in items]
+    return "".join(lines) + "\n"
+
+def _format_membership_notification(payment_id, member_id, events):
+    lines = [f"Send notification to user {member_id} of {len(events)} membership changes.\n"]
+    lines += [f" | {event} of their {membership_id} membership.\n" for event, membership_id in events]
+    return "".join(lines) + "\n"
+
+# Text templates for each action.  Templates are formatted with the payment_id followed by the fields.  Actions whose
+# fields are too structured for a template have a function instead, called with the same arguments.
+TEXT_FORMATS = {
+    "begin": "Beginning processing of payment of ${1:.2f} with id# {0}.\n",
+    "duplicate_id": "Processor received payment with duplicate ID - Not allowed.\n",
+    "duplicate_skipped": "Processor received payment with id# {0} duplicating a processed order - Skipped.\n\n",
+    "failed": " X Unhandled exception raised during processing!\n    > {1}\n - Processing aborted!\n\n",
+    "completed": " - Processing completed!\n\n",
+    "dead_letter": " X Payment with id# {0} failed {1} times - Moved to dead letters.\n\n",
+    "packing_slip": " | Generate packing slip for product {1} to address :{2}.\n",
+    "commission": " | Generate commission for agent {1} for ${2:.2f}.\n",
+    "no_commission": " | Checking... no commission due.\n",
+    "royalty_packing_slip": " | Generate royalty department packing slip for product {1} to address: {2}.\n",
+    "upgrade_email": " | Send email to user user {1} that their {2} has been upgraded.\n",
+    "activation_email": " | Send activation email to user user {1} for their {2} membership.\n",
+    "upgrade_membership": " | Upgrade membership of type {1} for user {2}.\n",
+    "activate_membership": " | Activate membership of type {1} for user {2}.\n",
+    "video_addon": " | Including add-on to packing slip: {1}\n",
+    "consolidated_packing_slip": _format_consolidated_packing_slip,
+    "commission_settlement": _format_commission_settlement,
+    "membership_notification": _format_membership_notification,
+}
+
+def format_text(record):
+    """
+    Format a record as the human readable text the processor has always printed.
+
+    :param record: A (payment_id, action, fields) tuple.
+    :return: The formatted text, including the trailing newline.
+    """
+    payment_id, action, fields = record
+    template = TEXT_FORMATS[action]
+    if callable(template):
+        return template(payment_id, *fields)
+    return template.format(payment_id, *fields)
+
+_json_encoder = json.JSONEncoder(separators=(",", ":"))
+
+def format_json(record):
+    """
+    Format a record as a compact JSON array of [payment_id, action, *fields], one per line.
+
+    :param record: A (payment_id, action, fields) tuple.
+    :return: The formatted line, including the trailing newline.
+    """
+    payment_id, action, fields = record
+    return _json_encoder.encode([payment_id, action, *fields]) + "\n"
+
+class ActionSink:
+    """
+    Base class for all sinks.  Subclasses must implement record, and should implement flush if they buffer.
+    """
+    def record(self, payment_id, action, fields=()):
+        """
+        Record a single action.  This is called on the processor's hot path, so it should be as cheap as possible.
+
+        :param payment_id: The id of the payment the action was taken for.
+        :param action: The kind of action, one of the keys of ACTION_FIELDS.
+        :param fields: A tuple of the values named for the action in ACTION_FIELDS.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Write out any buffered records.
+        """
+        pass
+
+    def close(self):
+        """
+        Flush and release any resources held by the sink.
+        """
+        self.flush()
+
+class NullSink(ActionSink):
+    """
+    Sink that discards every record.  Useful for benchmarks.
+    """
+    def record(self, payment_id, action, fields=()):
+        pass
+
+class MemorySink(ActionSink):
+    """
+    Sink that keeps every record in memory, in the list attribute records.
+    """
+    def __init__(self):
+        self.records = []
+
+    def record(self, payment_id, action, fields=()):
+        self.records.append((payment_id, action, fields))
+
+class BufferedSink(ActionSink):
+    """
+    Sink that buffers records and writes them out in bulk to a stream, once buffer_size records have accumulated or
+    when flushed.  Records are written as compact JSON lines unless another formatter is given.  Safe to record to
+    from multiple threads.
+    """
+    def __init__(self, stream=None, buffer_size=4096, formatter=format_json):
+        """
+        :param stream: A writable text stream.  Defaults to whatever sys.stdout is at the time of each write.
+        :param buffer_size: The number of records to hold before writing them out.
+        :param formatter: A function converting a record to a string.  Use format_text for human readable output.
+        """
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.formatter = formatter
+        self._buffer = []
+        self._lock = threading.Lock()
+
+    def record(self, payment_id, action, fields=()):
+        with self._lock:
+            self._buffer.append((payment_id, action, fields))
+            if len(self._buffer) >= self.buffer_size:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._buffer:
+            stream = sys.stdout if self.stream is None else self.stream
+            stream.write("".join(map(self.formatter, self._buffer)))
+            self._buffer = []
+
+class FileSink(BufferedSink):
+    """
+    Buffered sink that owns the file it writes to.  Close the sink when finished with it.
+    """
+    def __init__(self, path, buffer_size=4096, formatter=format_json):
+        """
+        :param path: The path of the file to write records to.  The file is overwritten.
+        :param buffer_size: The number of records to hold before writing them out.
+        :param formatter: A function converting a record to a string.
+        """
+        super().__init__(open(path, "w"), buffer_size, formatter)
+
+    def close(self):
+        super().close()
+        self.stream.close()
+
+class PrintSink(BufferedSink):
+    """
+    Sink that prints every record as human readable text to stdout as soon as it is recorded.  This is the
+    processor's default, and reproduces the output the processor has always had.
+    """
+    def __init__(self):
+        super().__init__(None, 1, format_text)
@@ -0,0 +1,327 @@
+"""
+Define a database backed by SQLite, as a drop-in replacement for the in-memory Database in database.py.  It offers the
+same interface that payments and the processor use: the price_table, commission_table and video_addons lookup tables,
+the processed_orders, failed_orders and dead_letters archives, and get_next_id.  Unlike Database, everything is
+persisted to disk, so the order archive does not need to fit in memory and survives a restart.
+
+Lookups are indexed by product_id and archives by payment_id.  Lookup tables are only read from disk the first time
+each key is requested and then cached in memory, as they are read only from the perspective of payments.  Writes to
+the archives are held back and written in batches, each inside a single transaction, so archiving does not cost a
+transaction per payment.  Call commit to write out anything still pending, and close when finished.
+
+Like the archives in Database, the archives here hold compact archive records rather than payments, see archive.py.
+A record is stored as the name of its payment class and the JSON encoded values of its fields.
+"""
+
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping, MutableMapping
+
+from archive import from_values, to_record
+from database import Database
+from id_allocator import BlockIdAllocator
+
+# Lookup tables, along with whether they have a default value, and the type of their values.
+LOOKUP_TABLES = {
+    "price_table": ("REAL", True),
+    "commission_table": ("REAL", True),
+    "video_addons": ("TEXT", False),
+}
+ARCHIVES = ("processed_orders", "failed_orders", "dead_letters")
+
+class SQLiteDatabase:
+    """
+    Database that persists everything to an SQLite file.  Construct it just once for the system, like Database.  The
+    first time a new file is opened, its lookup tables are filled with the contents of the tables in Database.
+    """
+    def __init__(self, path=":memory:", batch_size=1000, id_block_size=1000):
+        """
+        :param path: The path of the SQLite file to use.  By default an in-memory database is used, which will not
+        persist.
+        :param batch_size: The number of pending archive writes to hold before writing them out in one transaction.
+        :param id_block_size: The number of payment IDs leased from disk at a time by each thread.  IDs from a leased
+        block that are never handed out are skipped after a restart.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.id_block_size = id_block_size
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._create_schema()
+
+        self.price_table = SQLiteLookupTable(self, "price_table")
+        self.commission_table = SQLiteLookupTable(self, "commission_table")
+        self.video_addons = SQLiteLookupTable(self, "video_addons")
+        self.processed_orders = SQLiteOrderArchive(self, "processed_orders")
+        self.failed_orders = SQLiteOrderArchive(self, "failed_orders")
+        self.dead_letters = SQLiteOrderArchive(self, "dead_letters")
+        self.id_allocator = BlockIdAllocator(SQLiteLeaseSource(self), id_block_size)
+
+    def _create_schema(self):
+        with self._lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value)")
+            for table, (value_type, _) in LOOKUP_TABLES.items():
+                self.connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (product_id TEXT PRIMARY KEY, value {value_type} NOT NULL)"
+                )
+            for table in ARCHIVES:
+                self.connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (payment_id INTEGER PRIMARY KEY, payment_type TEXT NOT NULL, "
+                    f"product_id TEXT, record TEXT NOT NULL)"
+                )
+                self.connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_product_id ON {table} (product_id)")
+
+            seeded = self.connection.execute("SELECT value FROM settings WHERE name = 'seeded'").fetchone()
+            if seeded is None:
+                self._seed_lookup_tables()
+
+    def _seed_lookup_tables(self):
+        """
+        Fill the lookup tables and their defaults from the tables in Database, and start payment IDs at zero.
+        """
+        for table, (_, has_default) in LOOKUP_TABLES.items():
+            source = getattr(Database, table)
+            self.connection.executemany(f"INSERT INTO {table} VALUES (?, ?)", source.items())
+            if has_default:
+                self.connection.execute(
+                    "INSERT INTO settings VALUES (?, ?)", (f"{table}.default", source.default_factory())
+                )
+        self.connection.execute("INSERT INTO settings VALUES ('next_id', 0)")
+        self.connection.execute("INSERT INTO settings VALUES ('seeded', 1)")
+
+    def get_next_id(self):
+        return self.id_allocator.next_id()
+
+    def commit(self):
+        """
+        Write out every pending archive write.
+        """
+        with self._lock:
+            self.processed_orders.commit()
+            self.failed_orders.commit()
+            self.dead_letters.commit()
+
+    def close(self):
+        """
+        Commit and close the connection.  The database may not be used afterwards.
+        """
+        with self._lock:
+            self.commit()
+            self.connection.close()
+
+    def __getstate__(self):
+        # A connection cannot be pickled, so only the settings are sent and the copy opens its own connection.  This
+        # lets payments holding a reference to the database be sent to worker processes, though a database that is
+        # only in memory cannot be shared this way.
+        self.commit()
+        return {"path": self.path, "batch_size": self.batch_size, "id_block_size": self.id_block_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+class SQLiteLeaseSource:
+    """
+    Lease source for a BlockIdAllocator that keeps its count in the settings table of an SQLiteDatabase.  Leasing
+    takes a write lock on the file, so blocks are unique across every process using the same file.
+    """
+    def __init__(self, database):
+        """
+        :param database: The SQLiteDatabase to keep the count in.
+        """
+        self.database = database
+
+    def lease(self, count):
+        with self.database._lock:
+            connection = self.database.connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                start = connection.execute("SELECT value FROM settings WHERE name = 'next_id'").fetchone()[0]
+                connection.execute("UPDATE settings SET value = ? WHERE name = 'next_id'", (start + count,))
+            except Exception:
+                connection.rollback()
+                raise
+            connection.commit()
+            return start
+
+class SQLiteLookupTable(Mapping):
+    """
+    A read only lookup table, read through an in-memory cache.  Like the defaultdicts used by Database, a table with a
+    default returns the default for any key it does not contain, but 'in' is still only true for keys it contains.
+    """
+    def __init__(self, database, table):
+        """
+        :param database: The SQLiteDatabase the table belongs to.
+        :param table: The name of the table, one of the keys of LOOKUP_TABLES.
+        """
+        self.database = database
+        self.table = table
+        self._cache = {}
+        default = database.connection.execute(
+            "SELECT value FROM settings WHERE name = ?", (f"{table}.default",)
+        ).fetchone()
+        self._has_default = default is not None
+        self._default = default[0] if self._has_default else None
+
+    @property
+    def default(self):
+        """
+        The value returned for keys the table does not contain, or None if the table has no default.
+        """
+        return self._default
+
+    def _lookup(self, key):
+        """
+        :return: A tuple of (whether the table contains key, the value for key or the default).
+        """
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self.database._lock:
+            row = self.database.connection.execute(
+                f"SELECT value FROM {self.table} WHERE product_id = ?", (key,)
+            ).fetchone()
+        result = (True, row[0]) if row is not None else (False, self._default)
+        self._cache[key] = result
+        return result
+
+    def __getitem__(self, key):
+        found, value = self._lookup(key)
+        if not found and not self._has_default:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key)[0]
+
+    def __iter__(self):
+        with self.database._lock:
+            keys = [row[0] for row in self.database.connection.execute(f"SELECT product_id FROM {self.table}")]
+        return iter(keys)
+
+    def __len__(self):
+        with self.database._lock:
+            return self.database.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+class SQLiteOrderArchive(MutableMapping):
+    """
+    An archive of payments keyed by payment_id, stored as archive records.  Writes and deletions are held in memory
+    until batch_size of them are pending, and then written out together in one transaction.  Pending changes are
+    always visible to reads.
+    """
+    def __init__(self, database, table):
+        """
+        :param database: The SQLiteDatabase the archive belongs to.
+        :param table: The name of the table, one of ARCHIVES.
+        """
+        self.database = database
+        self.table = table
+        # Maps payment_id to the row to write, or None to delete it.
+        self._pending = {}
+
+    def __setitem__(self, payment_id, payment):
+        record = to_record(payment)
+        row = (payment_id, record.payment_type, getattr(record, "product_id", None), json.dumps(record))
+        with self.database._lock:
+            self._pending[payment_id] = row
+            if len(self._pending) >= self.database.batch_size:
+                self.commit()
+
+    def __getitem__(self, payment_id):
+        with self.database._lock:
+            if payment_id in self._pending:
+                row = self._pending[payment_id]
+            else:
+                row = self.database.connection.execute(
+                    f"SELECT * FROM {self.table} WHERE payment_id = ?", (payment_id,)
+                ).fetchone()
+        if row is None:
+            raise KeyError(payment_id)
+        return from_values(row[1], json.loads(row[3]))
+
+    def __delitem__(self, payment_id):
+        with self.database._lock:
+            if payment_id not in self:
+                raise KeyError(payment_id)
+            self._pending[payment_id] = None
+            if len(self._pending) >= self.database.batch_size:
+                self.commit()
+
+    def __contains__(self, payment_id):
+        with self.database._lock:
+            if payment_id in self._pending:
+                return self._pending[payment_id] is not None
+            return self.database.connection.execute(
+                f"SELECT 1 FROM {self.table} WHERE payment_id = ?", (payment_id,)
+            ).fetchone() is not None
+
+    def pop(self, payment_id, *default):
+        # Overridden so popping a missing payment, which the processor does for every successful payment, only costs
+        # a single indexed lookup.
+        with self.database._lock:
+            try:
+                record = self[payment_id]
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+            self._pending[payment_id] = None
+            if len(self._pending) >= self.database.batch_size:
+                self.commit()
+            return record
+
+    def __iter__(self):
+        with self.database._lock:
+            self.commit()
+            ids = [row[0] for row in self.database.connection.execute(
+                f"SELECT payment_id FROM {self.table} ORDER BY payment_id"
+            )]
+        return iter(ids)
+
+    def __len__(self):
+        with self.database._lock:
+            self.commit()
+            return self.database.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def clear(self):
+        with self.database._lock, self.database.connection:
+            self._pending.clear()
+            self.database.connection.execute(f"DELETE FROM {self.table}")
+
+    def ids_for_product(self, product_id):
+        """
+        Get the ids of every archived payment for a product, using the product_id index.
+
+        :param product_id: The product to look up.
+        :return: A list of payment ids, in ascending order.
+        """
+        with self.database._lock:
+            self.commit()
+            return [row[0] for row in self.database.connection.execute(
+                f"SELECT payment_id FROM {self.table} WHERE product_id = ? ORDER BY payment_id", (product_id,)
+            )]
+
+    def products(self):
+        """
+        :return: A list of every distinct product_id among the archived payments.
+        """
+        with self.database._lock:
+            self.commit()
+            return [row[0] for row in self.database.connection.execute(
+                f"SELECT DISTINCT product_id FROM {self.table} WHERE product_id IS NOT NULL"
+            )]
+
+    def commit(self):
+        """
+        Write every pending change out in a single transaction.
+        """
+        with self.database._lock:
+            if not self._pending:
+                return
+            writes = [row for row in self._pending.values() if row is not None]
+            deletes = [(payment_id,) for payment_id, row in self._pending.items() if row is None]
+            with self.database.connection:
+                self.database.connection.executemany(f"DELETE FROM {self.table} WHERE payment_id = ?", deletes)
+                self.database.connection.executemany(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)", writes)
+            self._pending.clear()
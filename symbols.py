@@ -0,0 +1,60 @@
+"""
+Define a symbol table for interning the string fields that repeat across many payments.  Fields such as product_id
+and agent hold one of a few thousand distinct values across millions of payments, but every payment read from a file
+or queue carries its own separate copy of each string.  Interning replaces each of those copies with the single
+canonical string held by the symbol table, so that payments, and the archive records made from them, all share one
+string per distinct value.
+
+Interned values are still plain strings, so the processor, the lookup tables of the database, and every sink use them
+unchanged, with no decoding for output.
+
+Only fields with few distinct values are worth interning.  A field that is different for nearly every payment, such as
+shipping_address or membership_id, would only fill the table with strings no other payment shares, keeping them alive
+after their payments are gone.  Since even a low cardinality field may turn out to have more values than expected, a
+table holds at most max_size strings.  Once it is full, new strings are passed through unchanged, while those already
+in the table are still interned, so the table never grows past its bound however long the process runs.
+
+The payment factory (see factory.py) interns INTERNED_FIELDS with the shared table, symbols, by default.
+"""
+
+import threading
+
+# The payment fields with few distinct values, worth interning.
+INTERNED_FIELDS = frozenset({"product_id", "agent", "membership_payment_type"})
+
+class SymbolTable:
+    """
+    Maps strings to canonical copies of themselves.  Safe to use from multiple threads.
+    """
+    def __init__(self, max_size=100_000):
+        """
+        :param max_size: The largest number of strings the table will hold.
+        """
+        self.max_size = max_size
+        self._canonical = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._canonical)
+
+    def __contains__(self, value):
+        return value in self._canonical
+
+    def intern(self, value):
+        """
+        :param value: Any value.
+        :return: The canonical copy of value if it is a string, adding it to the table if it is new and the table is
+        not full, or value unchanged otherwise.
+        """
+        if type(value) is not str:
+            return value
+        canonical = self._canonical.get(value)
+        if canonical is not None:
+            return canonical
+        with self._lock:
+            if len(self._canonical) < self.max_size:
+                return self._canonical.setdefault(value, value)
+        return value
+
+# The shared symbol table.
+symbols = SymbolTable()
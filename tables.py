@@ -0,0 +1,227 @@
+"""
+Define lookup tables that are loaded from a data file and reloaded whenever it changes, so that pricing, commission and
+add-on rules can be changed without a redeploy or a restart.  The tables in Database are fixed in code.
+
+The data file is JSON, holding an object for each of price_table, commission_table and video_addons, e.g.
+
+    {
+        "price_table": {"default": 9.99, "values": {"pants": 45.50, "apple": 1.99, "laptop": 1299.00}},
+        "commission_table": {"default": 0.1, "values": {"apple": 0.0, "laptop": 0.05}},
+        "video_addons": {"values": {"Learning to Ski": "First Aid"}}
+    }
+
+and save_snapshot writes out any database's tables in this format, to start from.
+
+Each load compiles the file into a TableSnapshot, holding an immutable LookupTable for each table, with its default
+already resolved.  A TableStore holds the current snapshot, and replaces it with a new one when the file changes.
+Replacing it is a single assignment, so readers never take a lock or wait, and every read sees either the old tables or
+the new ones, never a mix.  A file that fails to load is reported and otherwise ignored, leaving the last good snapshot
+in place.
+
+Give payments a SnapshotDatabase to have them, and the processor, read the tables of a TableStore.  Each payment reads
+whatever snapshot is current at the time, so a batch in flight picks up changed rules from its next payment on, without
+stopping.
+"""
+
+import json
+import os
+import threading
+
+from database import Database
+
+TABLES = ("price_table", "commission_table", "video_addons")
+
+class LookupTable(dict):
+    """
+    An immutable dict that, like a defaultdict, returns its default for keys it does not contain, but without adding
+    them.  'in' is only true for keys it contains.  Lookups of keys it contains cost the same as for a plain dict.
+    """
+    def __init__(self, values, default=None, has_default=False):
+        """
+        :param values: A dict of the values of the table.
+        :param default: The value returned for missing keys, if has_default.
+        :param has_default: If false, missing keys raise KeyError like a plain dict.
+        """
+        # Calling __init__ again on a table would otherwise refill it.
+        if "has_default" in self.__dict__:
+            self._immutable()
+        super().__init__(values)
+        object.__setattr__(self, "default", default)
+        object.__setattr__(self, "has_default", has_default)
+
+    def __missing__(self, key):
+        if self.has_default:
+            return self.default
+        raise KeyError(key)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("LookupTable is immutable, load a new snapshot instead.")
+
+    # Every method of dict that changes it in place.  | still works, returning a new plain dict.
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _immutable
+    __setattr__ = __delattr__ = _immutable
+
+    def __reduce__(self):
+        return LookupTable, (dict(self), self.default, self.has_default)
+
+class TableSnapshot:
+    """
+    An immutable set of the lookup tables, compiled from a single version of the data file.
+    """
+    def __init__(self, price_table, commission_table, video_addons, version=None):
+        """
+        :param price_table: The LookupTable of prices.
+        :param commission_table: The LookupTable of commission rates.
+        :param video_addons: The LookupTable of video add-ons.
+        :param version: An identifier for the version of the data file, e.g. its modification time.
+        """
+        self.price_table = price_table
+        self.commission_table = commission_table
+        self.video_addons = video_addons
+        self.version = version
+
+    @classmethod
+    def from_data(cls, data, version=None):
+        """
+        Compile a snapshot from the parsed contents of a data file.
+
+        :raises ValueError: if the data is not a valid table file.
+        """
+        tables = {}
+        for name in TABLES:
+            spec = data.get(name)
+            if not isinstance(spec, dict) or not isinstance(spec.get("values"), dict):
+                raise ValueError(f"Invalid table file: {name} must be an object with a values object.")
+            values = spec["values"]
+            if name != "video_addons":
+                numbers = list(values.values()) + ([spec["default"]] if "default" in spec else [])
+                if not all(type(number) in (int, float) for number in numbers):
+                    raise ValueError(f"Invalid table file: every value of {name} must be a number.")
+            tables[name] = LookupTable(values, spec.get("default"), "default" in spec)
+        return cls(version=version, **tables)
+
+def load_snapshot(path):
+    """
+    Load and compile a data file.
+
+    :param path: The path of the data file.
+    :return: A TableSnapshot, whose version is the modification time of the file.
+    :raises ValueError: if the file is not a valid table file.
+    """
+    version = os.stat(path).st_mtime_ns
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid table file: {e}") from None
+    return TableSnapshot.from_data(data, version)
+
+def save_snapshot(path, database):
+    """
+    Write the tables of a database to a data file.  The file is written in full and then moved into place, so a
+    TableStore watching it never reads a partly written file.
+
+    :param path: The path of the data file to write.
+    :param database: Any database, or TableSnapshot, with the three lookup tables.
+    """
+    data = {}
+    for name in TABLES:
+        table = getattr(database, name)
+        spec = data[name] = {"values": dict(table.items())}
+        if getattr(table, "default_factory", None) is not None:
+            spec["default"] = table.default_factory()
+        elif getattr(table, "has_default", False) or getattr(table, "default", None) is not None:
+            spec["default"] = table.default
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(temporary, path)
+
+class TableStore:
+    """
+    Holds the current TableSnapshot compiled from a data file, and reloads it when the file changes.  Call check to
+    reload if the file has changed, or start to have a background thread do so every interval seconds.
+    """
+    def __init__(self, path, interval=1.0, on_error=None):
+        """
+        :param path: The path of the data file.  It must exist and be valid when the store is created.
+        :param interval: The time, in seconds, between checks for changes by the background thread.
+        :param on_error: A function called with the ValueError or OSError raised by a failed reload.  Failed reloads
+        are also kept in last_error.
+        """
+        self.path = path
+        self.interval = interval
+        self.on_error = on_error
+        self.last_error = None
+        self.snapshot = load_snapshot(path)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """
+        Reload the data file if it has changed since the current snapshot was loaded.
+
+        :return: True if a new snapshot was swapped in.
+        """
+        try:
+            if os.stat(self.path).st_mtime_ns == self.snapshot.version:
+                return False
+            snapshot = load_snapshot(self.path)
+        except (OSError, ValueError) as e:
+            self.last_error = e
+            if self.on_error is not None:
+                self.on_error(e)
+            return False
+        # A single assignment, so readers see either the old snapshot or the new one.
+        self.snapshot = snapshot
+        self.last_error = None
+        return True
+
+    def start(self):
+        """
+        Start a daemon thread that checks for changes every interval seconds, until stop is called.
+        """
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="TableStore", daemon=True)
+            self._thread.start()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __getstate__(self):
+        # Threads cannot be pickled, so a copy sent to a worker process loads the file for itself.
+        return {"path": self.path, "interval": self.interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+class SnapshotDatabase(Database):
+    """
+    Database whose lookup tables are those of the current snapshot of a TableStore.  Everything else is shared with
+    Database.
+    """
+    def __init__(self, store):
+        """
+        :param store: The TableStore to read the tables from.
+        """
+        self.store = store
+
+    @property
+    def price_table(self):
+        return self.store.snapshot.price_table
+
+    @property
+    def commission_table(self):
+        return self.store.snapshot.commission_table
+
+    @property
+    def video_addons(self):
+        return self.store.snapshot.video_addons
@@ -0,0 +1,69 @@
+"""
+This script is for testing that a windowed order archive, which spills its oldest records to disk (see archive.py),
+reads back exactly what an archive held entirely in memory does: every record, in the same order, through every way of
+reading, popping and indexing the archive, and turned back into payments.
+"""
+
+import os
+import pickle
+import tempfile
+
+import benchmark
+from archive import OrderArchive
+from database import Database
+from payment import payment_fields
+
+COUNT = 5000
+WINDOW = 300
+
+database = Database()
+payments = list(benchmark.generate_payments(database, COUNT, seed=11))
+
+with tempfile.TemporaryDirectory() as directory:
+    memory = OrderArchive()
+    windowed = OrderArchive(WINDOW, os.path.join(directory, "archive.spill"))
+    for archive in (memory, windowed):
+        for each in payments:
+            archive[each.payment_id] = each
+
+    assert len(windowed._memory) == WINDOW and windowed._spilled_count == COUNT - WINDOW
+    assert len(windowed) == len(memory) == COUNT
+    assert list(windowed) == list(memory)
+    for payment_id in memory:
+        assert windowed[payment_id] == memory[payment_id] and payment_id in windowed
+    assert sorted(windowed.products()) == sorted(memory.products())
+    for product_id in memory.products():
+        assert windowed.ids_for_product(product_id) == memory.ids_for_product(product_id)
+    print(f"Read back {COUNT} records, {COUNT - WINDOW} of them spilled.")
+
+    # Spilled records turn back into the payments they were made from.
+    for each in payments[:100]:
+        restored = windowed[each.payment_id].to_payment(database)
+        assert type(restored) is type(each)
+        for field in payment_fields(type(each)):
+            assert getattr(restored, field) == getattr(each, field)
+
+    # Popping and archiving again work the same on spilled records and on records in memory.
+    for payment_id in (payments[0].payment_id, payments[-1].payment_id, payments[1000].payment_id):
+        for archive in (memory, windowed):
+            assert archive.pop(payment_id).payment_id == payment_id
+            assert payment_id not in archive and archive.pop(payment_id, None) is None
+    for each in payments[2000:2010]:
+        for archive in (memory, windowed):
+            archive[each.payment_id] = each
+    assert len(windowed) == len(memory) == COUNT - 3
+    assert set(windowed) == set(memory)
+    for product_id in memory.products():
+        assert windowed.ids_for_product(product_id) == memory.ids_for_product(product_id)
+    print("Popped and archived again records both spilled and in memory.")
+
+    # A windowed archive cannot take its spill file to another process, so it pickles as an empty archive.
+    copied = pickle.loads(pickle.dumps(windowed))
+    assert len(copied) == 0 and copied.window is None
+    assert list(pickle.loads(pickle.dumps(memory))) == list(memory)
+
+    windowed.clear()
+    assert len(windowed) == 0 and list(windowed) == [] and windowed.products() == []
+    windowed.close()
+
+print("All archive checks passed.")
@@ -0,0 +1,104 @@
+"""
+This script is for testing that a checkpointed run over an input can be resumed after a crash (see checkpoint.py).  A
+first run crashes partway through, losing its unwritten log entries, a second run resumes it, and a third run retries
+the failures once their cause is fixed.  Every payment must end up completed, none may be processed again unless its
+log entry was lost in the crash, and the log must stay small throughout.
+"""
+
+import os
+import tempfile
+
+import benchmark
+import checkpoint
+from archive import OrderArchive
+from database import Database
+from processor import Processor
+from sink import MemorySink
+
+COUNT = 5000
+BATCH_SIZE = 100
+CRASH_AT = 2550
+
+class Crash(Exception):
+    pass
+
+class RecordingProcessor(Processor):
+    """
+    Remembers the position in the input of every payment it processes, and fails every laptop if flaky.
+    """
+    def __init__(self, database, ordinals, flaky):
+        super().__init__(database, MemorySink())
+        self.ordinals = ordinals
+        self.flaky = flaky
+        self.processed = []
+
+    def process_payment(self, payment):
+        self.processed.append(self.ordinals[payment.payment_id])
+        return super().process_payment(payment)
+
+    def generate_packing_slip(self, payment):
+        if self.flaky and payment.product_id == "laptop":
+            raise RuntimeError("packing slip printer jammed")
+        super().generate_packing_slip(payment)
+
+def run(path, flaky, crash_at=None):
+    """
+    Run over the same input as every other run, as a rerun after a crash would.
+
+    :return: A tuple of (the processor, the progress log).
+    """
+    database = Database()
+    database.processed_orders = OrderArchive()
+    database.failed_orders = OrderArchive()
+    ordinals = {}
+    processor = RecordingProcessor(database, ordinals, flaky)
+    progress = checkpoint.ProgressLog(path, batch_size=BATCH_SIZE, checkpoint_interval=1000)
+
+    def payments():
+        for ordinal, each in enumerate(benchmark.generate_payments(database, COUNT, seed=7)):
+            if ordinal == crash_at:
+                raise Crash()
+            ordinals[each.payment_id] = ordinal
+            yield each
+
+    try:
+        for _ in checkpoint.iter_failures(processor, payments(), progress):
+            pass
+    except Crash:
+        # A crash leaves the log unclosed, and loses every entry that was not yet written.
+        progress.file.close()
+    else:
+        progress.close()
+    return processor, progress
+
+with tempfile.TemporaryDirectory() as directory:
+    path = os.path.join(directory, "progress.log")
+
+    first, _ = run(path, flaky=True, crash_at=CRASH_AT)
+    assert first.processed == list(range(CRASH_AT))
+
+    second, progress = run(path, flaky=True)
+    again = set(first.processed) & set(second.processed)
+    assert set(first.processed) | set(second.processed) == set(range(COUNT))
+    failures = set(progress._failed)
+    assert failures, "expected some failures"
+    # Only failures, and the entries lost in the crash, are processed a second time.
+    lost = again - failures
+    assert len(lost) < BATCH_SIZE and min(lost) >= CRASH_AT - BATCH_SIZE, sorted(lost)
+    assert progress.watermark == COUNT
+    # Opening the log checkpoints it, leaving just the watermark and the failures.
+    checkpoint.ProgressLog(path).close()
+    with open(path) as f:
+        assert f.read().splitlines() == [f"w {COUNT}"] + [f"f {ordinal}" for ordinal in sorted(failures)]
+    print(f"Resumed after a crash at {CRASH_AT}: {len(lost)} payments processed again, {len(failures)} failures.")
+
+    third, progress = run(path, flaky=False)
+    assert sorted(third.processed) == sorted(failures)
+    assert not progress._failed and progress.watermark == COUNT
+    fourth, _ = run(path, flaky=False)
+    assert fourth.processed == []
+    with open(path) as f:
+        assert f.read() == f"w {COUNT}\n"
+    print(f"Retried {len(failures)} failures, leaving nothing to do.")
+
+print("All checkpoint checks passed.")
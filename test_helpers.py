@@ -64,3 +64,10 @@ class BigMeal(Meal, Desert):
 
 payment.helper_check_required_kwargs(BigMeal)
 
+
+print("======================================================================")
+
+from plan import compile_plan
+
+print(compile_plan(payment.Book))
+print(compile_plan(payment.Video))
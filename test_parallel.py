@@ -0,0 +1,53 @@
+"""
+This script is for testing that processing payments in parallel gives exactly the same results as processing them
+serially: the same action records in the same order, the same archives, and the same failures.  Payments are handed to
+the workers as binary batches in shared memory (see binary.py), so it also checks that none are left behind.
+"""
+
+import os
+
+import benchmark
+import binary
+from processor import Processor
+from sink import MemorySink
+
+class FlakyProcessor(Processor):
+    """
+    Fails every payment for one product, so that failures are merged back in too.
+    """
+    def generate_packing_slip(self, payment):
+        if payment.product_id == "laptop":
+            raise RuntimeError("packing slip printer jammed")
+        super().generate_packing_slip(payment)
+
+def run(payments, database, **kwargs):
+    sink = MemorySink()
+    failed = FlakyProcessor(database, sink).process_payments(payments, **kwargs)
+    return sink.records, [p.payment_id for p in failed], list(database.processed_orders), list(database.failed_orders)
+
+if __name__ == "__main__":
+    shared_before = set(os.listdir("/dev/shm")) if os.path.isdir("/dev/shm") else set()
+
+    database = benchmark.private_database()
+    payments = list(benchmark.generate_payments(database, 3000, seed=3))
+    serial = run(payments, database)
+    assert serial[1], "expected some failures"
+    for shard_key in ("payment_id", "product_id"):
+        database = benchmark.private_database()
+        for each in payments:
+            each.database = database
+        parallel = run(payments, database, workers=3, chunk_size=200, shard_key=shard_key)
+        assert parallel == serial, f"parallel results sharded by {shard_key} differ from serial results"
+        print(f"Sharded by {shard_key}: {len(parallel[0])} action records match.")
+
+    # A list of views over a binary batch is sent to the workers just like payments.
+    books = [each for each in payments if type(each).__name__ == "Book"]
+    view = binary.BatchView(binary.encode_batch(books), benchmark.private_database())
+    serial = run(list(view), view.database)
+    view.database = benchmark.private_database()
+    assert run(list(view), view.database, workers=2) == serial
+    print(f"Views: {len(serial[0])} action records match.")
+
+    if os.path.isdir("/dev/shm"):
+        assert set(os.listdir("/dev/shm")) <= shared_before, "shared memory blocks were left behind"
+    print("All parallel checks passed.")
@@ -0,0 +1,42 @@
+"""
+This script is for testing that batch.round_cents, the vectorized rounding used by batch.py and simulation.py, gives
+exactly the same result as python's round(amount, 2), which is what Processor.generate_commission uses.  The hard
+cases are the amounts that lie within rounding error of a half cent, so those are generated on purpose, alongside
+random amounts and commissions computed the way the processor computes them.
+"""
+
+import random
+
+import numpy as np
+
+from batch import round_cents
+
+def check(name, amounts):
+    amounts = np.asarray(amounts, dtype=np.float64)
+    rounded = round_cents(amounts)
+    expected = np.array([round(amount, 2) for amount in amounts.tolist()], dtype=np.float64)
+    wrong = np.flatnonzero(rounded != expected)
+    if len(wrong):
+        first = wrong[0]
+        raise AssertionError(
+            f"{name}: round_cents({amounts[first]!r}) gave {rounded[first]!r}, not {expected[first]!r}, and "
+            f"{len(wrong) - 1} more."
+        )
+    print(f"{name}: {len(amounts)} amounts match round().")
+
+rng = random.Random(5)
+
+check("Random amounts", [rng.uniform(-10000.0, 10000.0) for _ in range(200000)])
+
+# Every whole number of cents plus a half, and the floats on either side of it.
+halves = np.arange(-200000, 200000) / 100.0 + 0.005
+check("Half cents", np.concatenate([halves, np.nextafter(halves, np.inf), np.nextafter(halves, -np.inf)]))
+
+# Commissions as the processor computes them: a rate from the commission table times a value in cents.
+rates = [0.0, 0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.33, 0.07, 0.125]
+values = [rng.randrange(1, 1000000) / 100.0 for _ in range(50000)]
+check("Commissions", [rate * value for rate in rates for value in values])
+
+check("Edge cases", [0.0, -0.0, 0.005, -0.005, 0.015, 0.025, 1.005, 2.675, 1e15 + 0.5, 1e-300, 5e-324, 1e300])
+
+print("All round_cents checks passed.")